@@ -3,10 +3,15 @@ import requests
 import numpy
 import pandas as pd
 import os
+import re
+import json
+import hashlib
+import time
+from decimal import Decimal, ROUND_HALF_EVEN
 from bs4 import BeautifulSoup
-from datetime import timedelta
+from datetime import datetime, timedelta
 from airflow import DAG
-from airflow.operators.python_operator import PythonOperator
+from airflow.operators.python_operator import PythonOperator, ShortCircuitOperator
 from airflow.utils.dates import days_ago
 
 # defining DAG arguments
@@ -28,17 +33,202 @@ dag = DAG(
     schedule_interval=timedelta(days=1)
 )
 
+# Decimal values (precision "decimal" of transform) are stored as text on SQLite to keep them exact,
+# on their own <table>_decimal tables (see load_to_db) so the REAL columns of float runs never hold them
+sqlite3.register_adapter(Decimal, str)
+
+# Intermediate data handed over between tasks is stored as typed Parquet files on a directory per DAG run,
+# and tasks just pass the path of their file through XCom. Files of other runs are removed after retention_hours (see prune_intermediates)
+intermediate_settings = {
+    "base_dir": os.environ.get("ETL_INTERMEDIATE_DIR", "etl_intermediates"),
+    "retention_hours": float(os.environ.get("ETL_INTERMEDIATE_RETENTION_HOURS", 24))}
+
+def intermediate_path(run_id: str, task_id: str, extension: str = "parquet") -> str:
+    """
+    Returns the path of the intermediate Parquet file of a task on a DAG run (base_dir/run_id/task_id.parquet)
+    """
+    run_dir = re.sub(r"[^\w.-]", "_", run_id)
+    return os.path.join(intermediate_settings["base_dir"], run_dir, f'{task_id}.{extension}')
+
+def write_intermediate(dataframe, context, name: str = None) -> str:
+    """
+    Writes the output dataframe of the running task to its run scoped Parquet file and returns the path,
+    which the task returns so it is the only thing stored on XCom. name tells apart the files of a task that writes
+    several ones, or of the mapped instances of a task (one per source).
+    The file is written under a temporary name and then renamed, so a retried task never leaves half a file.
+    """
+    file_id = context["ti"].task_id if name is None else f'{context["ti"].task_id}-{name}'
+    path = intermediate_path(context["run_id"], file_id)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    dataframe.to_parquet(f'{path}.tmp', index = False)
+    os.replace(f'{path}.tmp', path)
+    return path
+
+def read_intermediate(context, task_id: str, name: str = None):
+    """
+    Reads the dataframe written by an upstream task of the same DAG run from the path it left on XCom
+    (or from the path under name when the task left a dict of paths)
+    """
+    path = context["ti"].xcom_pull(task_ids = task_id)
+    if name is not None:
+        path = path[name]
+    return pd.read_parquet(path)
+
+def prune_intermediates(context) -> int:
+    """
+    Retention policy of the intermediate files. Files referenced by the stored source fingerprints are always kept,
+    as unchanged sources are merged from them on the next runs. Any other file of the running DAG run is removed,
+    and files of other runs once they are older than retention_hours, so overlapping runs and backfills still find theirs.
+    Emptied run directories are removed. Returns the number of removed files.
+    """
+    base_dir = intermediate_settings["base_dir"]
+    if not os.path.isdir(base_dir):
+        return 0
+    referenced = {os.path.abspath(fingerprint["path"]) for fingerprint in read_fingerprints().values() if fingerprint.get("path")}
+    current_run_dir = os.path.abspath(os.path.dirname(intermediate_path(context["run_id"], "")))
+    expired = time.time() - intermediate_settings["retention_hours"] * 60 * 60
+    removed = 0
+    for run_dir in os.scandir(base_dir):
+        if not run_dir.is_dir():
+            continue
+        for entry in os.scandir(run_dir.path):
+            path = os.path.abspath(entry.path)
+            if path in referenced:
+                continue
+            try:
+                if os.path.abspath(run_dir.path) == current_run_dir or entry.stat().st_mtime < expired:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(run_dir.path)
+        except OSError:
+            pass
+    print(f'{removed} intermediate files removed')
+    return removed
+
+# Fingerprint of every source as of the last loaded run: ETag and Last-Modified headers for conditional requests,
+# sha256 of the content and path of the intermediate file extracted from it
+def fingerprint_file() -> str:
+    """
+    Returns the path of the JSON file that stores the source fingerprints
+    """
+    return os.path.join(intermediate_settings["base_dir"], "source_fingerprints.json")
+
+def read_fingerprints() -> dict:
+    """
+    Returns the stored fingerprints as a dict {source: fingerprint}, empty when nothing was loaded yet
+    """
+    try:
+        with open(fingerprint_file()) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def conditional_headers(fingerprint: dict) -> dict:
+    """
+    Returns the If-None-Match/If-Modified-Since headers of a stored fingerprint. Nothing is sent when the intermediate
+    file of the fingerprint is gone, as a "not modified" answer could not be served then.
+    """
+    if not fingerprint.get("path") or not os.path.exists(fingerprint["path"]):
+        return {}
+    headers = {}
+    if fingerprint.get("etag"):
+        headers["If-None-Match"] = fingerprint["etag"]
+    if fingerprint.get("last_modified"):
+        headers["If-Modified-Since"] = fingerprint["last_modified"]
+    return headers
+
+def unchanged_content(fingerprint: dict, content_hash: str) -> bool:
+    """
+    Tells if the downloaded content is the one of the stored fingerprint and its intermediate file is still available
+    """
+    return content_hash == fingerprint.get("sha256") and bool(fingerprint.get("path")) and os.path.exists(fingerprint["path"])
+
+def source_result(source: str, kind: str, changed: bool, fingerprint: dict) -> dict:
+    """
+    Returns the XCom value of an extract task: the source name and kind, whether it changed since the last loaded run
+    and its new fingerprint, whose path is the intermediate file of the source (stored by load_to_db once loaded)
+    """
+    print(f'Source {source} {"changed" if changed else "did not change"} since the last loaded run')
+    return {"source": source, "kind": kind, "changed": changed, **fingerprint}
+
+def store_fingerprints(context, merge_task_id: str):
+    """
+    Stores the fingerprints of the sources merged on the run, so the next runs compare against the loaded data.
+    Sources no longer on the manifest are dropped.
+    """
+    fingerprints = context["ti"].xcom_pull(task_ids = merge_task_id)["fingerprints"]
+    os.makedirs(os.path.dirname(fingerprint_file()), exist_ok = True)
+    with open(f'{fingerprint_file()}.tmp', "w") as file:
+        json.dump(fingerprints, file, indent = 2)
+    os.replace(f'{fingerprint_file()}.tmp', fingerprint_file())
+
+def sources_changed(merge_task_id = "merge_sources", **context) -> bool:
+    """
+    ShortCircuit gate: returns False, which skips transform and load_to_db, when no source changed since the last
+    loaded run. Triggering the DAG with {"force_refresh": true} as conf always lets them run.
+    Skipped runs prune their intermediate files here, as load_to_db does not run for them.
+    """
+    dag_run = context.get("dag_run")
+    if dag_run is not None and (dag_run.conf or {}).get("force_refresh"):
+        return True
+    changed = context["ti"].xcom_pull(task_ids = merge_task_id)["changed"]
+    if not changed:
+        prune_intermediates(context)
+    return changed
+
+# Sources to extract are listed on a JSON manifest ([{"name": ..., "kind": "bank_table" or "exchange_rate", "url": ...}, ...])
+# and every source is extracted by its own mapped task instance, at most max_parallel_extracts at a time on the given pool
+extraction_settings = {
+    "manifest": os.environ.get("ETL_SOURCE_MANIFEST", os.path.join(os.path.dirname(os.path.abspath(__file__)), "etl_sources.json")),
+    "pool": os.environ.get("ETL_EXTRACT_POOL", "default_pool"),
+    "max_parallel_extracts": int(os.environ.get("ETL_MAX_PARALLEL_EXTRACTS", "8"))}
+
+bank_data_url = 'https://web.archive.org/web/20230908091635%20/https://en.wikipedia.org/wiki/List_of_largest_banks'
+exchange_rate_url = 'https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBMSkillsNetwork-PY0221EN-Coursera/labs/v2/exchange_rate.csv'
+
+# used when there is no manifest file
+default_sources = [
+    {"name": "bank_data", "kind": "bank_table", "url": bank_data_url},
+    {"name": "exchange_rate", "kind": "exchange_rate", "url": exchange_rate_url}]
+
 # defining tasks definitions
 
-def extract_bank_data():
+def read_source_manifest(**context) -> list:
+    """
+    Reads the source manifest and returns the op_kwargs of every mapped extract_source task instance
+    """
+    try:
+        with open(extraction_settings["manifest"]) as file:
+            sources = json.load(file)
+    except FileNotFoundError:
+        print(f'No source manifest found at {extraction_settings["manifest"]}, the default sources are extracted')
+        sources = default_sources
+    names = [source["name"] for source in sources]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Source names on the manifest must be unique: {names}')
+    for source in sources:
+        if source["kind"] not in source_extractors:
+            raise ValueError(f'Unknown kind {source["kind"]} of source {source["name"]}. Use one of {list(source_extractors)}')
+    return [{"source": source} for source in sources]
+
+def extract_bank_data(url = bank_data_url, source = "bank_data", **context):
     """
     Goes into given url and web scrapes data from largest banks worldwide.
-    Extract just required data from a table and dumps into a CSV file
-    which is stored on the parent directory of this python file (opt/airflow)
+    Extract just required data from a table and dumps into the intermediate Parquet file of this DAG run
+    (see write_intermediate), whose path is returned to XCom.
+    The page is requested conditionally and fingerprinted, when it did not change the last extracted file is reused.
     """
-    url = 'https://web.archive.org/web/20230908091635%20/https://en.wikipedia.org/wiki/List_of_largest_banks'
-    request = requests.get(url)
+    fingerprint = read_fingerprints().get(source, {})
+    request = requests.get(url, headers = conditional_headers(fingerprint))
+    if request.status_code == 304:
+        return source_result(source, "bank_table", False, fingerprint)
     if request.status_code == 200:
+        content_hash = hashlib.sha256(request.content).hexdigest()
+        if unchanged_content(fingerprint, content_hash):
+            return source_result(source, "bank_table", False, fingerprint)
         soup = BeautifulSoup(request.text, features="html.parser")
         all_tables = soup.find_all('tbody')
         DATA = {
@@ -59,68 +249,229 @@ def extract_bank_data():
             DATA['MC_USD_Billion'].append(row.find_all('td')[2].text.replace('\n',''))
         
         dataframe = pd.DataFrame(DATA)
-        try:
-            dataframe.to_csv("List_of_largest_banks.csv", index = False)
-        except FileExistsError:
-            os.remove("List_of_largest_banks.csv")
-            dataframe.to_csv("List_of_largest_banks.csv", index = False)
+        dataframe['MC_USD_Billion'] = dataframe['MC_USD_Billion'].astype('float64')
+        path = write_intermediate(dataframe, context, source)
+        return source_result(source, "bank_table", True, {"etag": request.headers.get("ETag"),
+                                                          "last_modified": request.headers.get("Last-Modified"),
+                                                          "sha256": content_hash,
+                                                          "path": path})
     else:
-        print("The server is not reachable")
+        raise ValueError(f'The server is not reachable. Status code: {request.status_code}')
+
+def extract_exchange_rate(url = exchange_rate_url, source = "exchange_rate", **context):
+    """
+    Requests a csv file from a given url and extracs the data into the intermediate Parquet file of this DAG run
+    (see write_intermediate), whose path is returned to XCom.
+    The file is requested conditionally and streamed to disk in chunks while it is fingerprinted,
+    when it did not change the last extracted file is reused.
+    """
+    fingerprint = read_fingerprints().get(source, {})
+    raw_file = intermediate_path(context["run_id"], f'{context["ti"].task_id}-{source}', "csv")
+    os.makedirs(os.path.dirname(raw_file), exist_ok = True)
+    content_hash = hashlib.sha256()
+    with requests.get(url, headers = conditional_headers(fingerprint), allow_redirects=True, stream = True) as csv:
+        if csv.status_code == 304:
+            return source_result(source, "exchange_rate", False, fingerprint)
+        csv.raise_for_status()
+        with open(raw_file, 'wb') as file:
+            for chunk in csv.iter_content(chunk_size = 1024 * 1024):
+                file.write(chunk)
+                content_hash.update(chunk)
+        etag, last_modified = csv.headers.get("ETag"), csv.headers.get("Last-Modified")
+    if unchanged_content(fingerprint, content_hash.hexdigest()):
+        os.remove(raw_file)
+        return source_result(source, "exchange_rate", False, fingerprint)
+    ex_rates_df = pd.read_csv(raw_file, dtype = {"Currency": "string", "Rate": "float64"})
+    path = write_intermediate(ex_rates_df, context, source)
+    return source_result(source, "exchange_rate", True, {"etag": etag, "last_modified": last_modified,
+                                                         "sha256": content_hash.hexdigest(), "path": path})
+
+source_extractors = {"bank_table": extract_bank_data, "exchange_rate": extract_exchange_rate}
 
-def extract_exchange_rate():
+def extract_source(source: dict, **context) -> dict:
     """
-    Requests a csv file from a given url and extracs the data to generate a local CSV
-    which is which is stored on the parent directory of this python file (opt/airflow)
+    Extracts one source of the manifest with the extract function of its kind (one mapped task instance per source)
     """
-    url = 'https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBMSkillsNetwork-PY0221EN-Coursera/labs/v2/exchange_rate.csv'
-    csv = requests.get(url, allow_redirects=True)
-    with open('ex_rate_file.csv', 'wb') as file:
-        file.write(csv.content)
+    return source_extractors[source["kind"]](url = source["url"], source = source["name"], **context)
 
-def transform():
+def merge_sources(extract_task_id = "extract_source", **context) -> dict:
     """
-    Retrieves the data stored on the CSV files generated on previous extraction steps
-    transforms it and generates extra data. Then dumps it on a CSV file which is stored on the parent directory of this python file (opt/airflow)
+    Reduce step of the mapped extraction: concatenates the bank tables of every source into one intermediate file
+    and the exchange rates into another (a bank or currency on several sources keeps its last value),
+    and tells if any source changed (or the manifest lost a source) since the last loaded run.
+    Returns to XCom the paths of both files, the changed flag and the fingerprints of the sources.
     """
-    bank_data_df = pd.read_csv("List_of_largest_banks.csv")
-    ex_rates_df = pd.read_csv("ex_rate_file.csv")
+    results = list(context["ti"].xcom_pull(task_ids = extract_task_id))
+    fingerprints = {result["source"]: {key: result[key] for key in ["etag", "last_modified", "sha256", "path"]} for result in results}
+    merged = {"changed": any(result["changed"] for result in results) or set(fingerprints) != set(read_fingerprints()),
+              "fingerprints": fingerprints}
+    for kind, name, key_column in [("bank_table", "bank_data", "Name"), ("exchange_rate", "exchange_rate", "Currency")]:
+        shards = [pd.read_parquet(result["path"]) for result in results if result["kind"] == kind]
+        if not shards:
+            raise ValueError(f'The source manifest has no source of kind {kind}')
+        merged_df = pd.concat(shards, ignore_index = True).drop_duplicates(subset = key_column, keep = "last")
+        merged[name] = write_intermediate(merged_df, context, name)
+    return merged
+
+def convert_currencies(bank_data_df, ex_rates_df, precision = "float64", layout = "wide"):
+    """
+    Converts the market cap of every bank to every currency with a single broadcast of the market cap vector
+    against the rate vector (an outer product), rounded to 2 decimals.
+    layout "wide" returns the bank data plus one MC_<Currency>_Billion column per currency, built in one allocation,
+    and layout "long" returns a (Name, Currency, MC_Billion) table.
+    precision "float64" gives the same values as rounding each column apart, "float32" halves the memory of the
+    converted values, and "decimal" computes them exactly as Decimal objects (no float rounding errors, but at python speed).
+    """
+    market_caps = bank_data_df['MC_USD_Billion'].to_numpy(dtype = numpy.float64)
+    rates = ex_rates_df['Rate'].to_numpy(dtype = numpy.float64)
+    currencies = ex_rates_df['Currency'].astype(str).to_numpy()
+    if precision == "decimal":
+        cent = Decimal("0.01")
+        to_decimal = numpy.frompyfunc(lambda value: Decimal(repr(value)), 1, 1)
+        quantize = numpy.frompyfunc(lambda value: value.quantize(cent, rounding = ROUND_HALF_EVEN), 1, 1)
+        converted = quantize(numpy.multiply.outer(to_decimal(market_caps), to_decimal(rates)))
+    elif precision in ("float64", "float32"):
+        converted = numpy.multiply.outer(market_caps.astype(precision), rates.astype(precision))
+        numpy.round(converted, 2, out = converted)
+    else:
+        raise ValueError(f'Unknown precision {precision}. Use "float64", "float32" or "decimal"')
+    if layout == "long":
+        return pd.DataFrame({'Name': numpy.repeat(bank_data_df['Name'].to_numpy(), len(currencies)),
+                             'Currency': numpy.tile(currencies, len(market_caps)),
+                             'MC_Billion': converted.ravel()})
+    if layout != "wide":
+        raise ValueError(f'Unknown layout {layout}. Use "wide" or "long"')
+    converted_df = pd.DataFrame(converted, columns = [f'MC_{currency}_Billion' for currency in currencies], index = bank_data_df.index)
+    return pd.concat([bank_data_df, converted_df], axis = 1)
+
+def transform(merge_task_id = "merge_sources", precision = "float64", layout = "wide", **context):
+    """
+    Retrieves the data stored on the intermediate files merged from the previous extraction steps of this DAG run
+    transforms it and generates extra data (see convert_currencies, precision and layout can be set on op_kwargs).
+    Then dumps it on its own intermediate file, whose path is returned to XCom
+    """
+    bank_data_df = read_intermediate(context, merge_task_id, "bank_data")
+    ex_rates_df = read_intermediate(context, merge_task_id, "exchange_rate")
     bank_data_df['MC_USD_Billion'] = numpy.float64(bank_data_df['MC_USD_Billion'])
-    for rates in range(0, len(ex_rates_df)):
-        column_name = f'MC_{ex_rates_df["Currency"].iloc[rates]}_Billion'
-        bank_data_df[column_name] = round(bank_data_df['MC_USD_Billion']*ex_rates_df['Rate'].iloc[rates],2)
-    try:
-        bank_data_df.to_csv("transformed_data.csv", index = False)
-    except FileExistsError:
-        os.remove("transformed_data.csv")
-        bank_data_df.to_csv("transformed_data.csv", index = False)
-        
-def load_to_db():
+    transformed_df = convert_currencies(bank_data_df, ex_rates_df, precision, layout)
+    return write_intermediate(transformed_df, context)
+
+# Pragmas set on every connection to bank_data.db: WAL lets readers query the database while a load is running
+# and NORMAL synchronous is safe with WAL while syncing much less often than FULL
+sqlite_pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -64000,
+    "mmap_size": 256 * 1024 * 1024}
+
+def bank_db_conn(db_name: str):
     """
-    Generates a sqlite like db file, then gets data from the transformed_data CSV file and dumps it into DB file
-    called bank_data.db which is stored on the parent directory of this python file (opt/airflow)
+    Opens a connection to the SQLite database file (created if missing) with the tuned pragmas applied
     """
-    db_name = "bank_data.db"
-    try:
-        with open(db_name, "x"):
-            pass
-    except FileExistsError:
-        os.rmdir(db_name)
-        with open(db_name, "x"):
-            pass
-    transformed_data_df = pd.read_csv("transformed_data.csv")
     db_conn = sqlite3.connect(db_name)
-    transformed_data_df.to_sql(con = db_conn, name = "transformed_data", if_exists = 'replace', index = False)
-    db_conn.close()
+    for pragma, value in sqlite_pragmas.items():
+        db_conn.execute(f'PRAGMA {pragma} = {value}')
+    return db_conn
+
+def sqlite_type(dtype) -> str:
+    """
+    Returns the SQLite column type of a pandas dtype
+    """
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+def has_decimal_values(dataframe) -> bool:
+    """
+    Tells if the dataframe holds Decimal values (precision "decimal" of convert_currencies) on any of its columns
+    """
+    return any(isinstance(column.dropna().iloc[0], Decimal) for _, column in dataframe.items()
+               if column.dtype == object and column.notna().any())
+
+def prepare_snapshot_table(db_conn, table: str, dataframe, key_columns: list):
+    """
+    Creates the snapshot table (primary key on key_columns) and its indexes if they do not exist, and adds the columns
+    of dataframe the table does not have yet (e.g. a new currency). A table left by the previous full rewrite loads,
+    which has no snapshot_date, is kept renamed to <table>_before_snapshots.
+    """
+    existing_columns = [row[1] for row in db_conn.execute(f'PRAGMA table_info("{table}")')]
+    if existing_columns and "snapshot_date" not in existing_columns:
+        print(f'Table {table} has no snapshot_date, it is kept as {table}_before_snapshots')
+        db_conn.execute(f'ALTER TABLE "{table}" RENAME TO "{table}_before_snapshots"')
+        existing_columns = []
+    if not existing_columns:
+        column_definitions = ", ".join(f'"{column}" {sqlite_type(dtype)}' for column, dtype in dataframe.dtypes.items())
+        primary_key = ", ".join(f'"{column}"' for column in key_columns)
+        db_conn.execute(f'CREATE TABLE "{table}" ({column_definitions}, PRIMARY KEY ({primary_key}))')
+    else:
+        for column, dtype in dataframe.dtypes.items():
+            if column not in existing_columns:
+                db_conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {sqlite_type(dtype)}')
+    # the primary key already serves lookups by bank name, these ones serve queries by day (and currency)
+    db_conn.execute(f'CREATE INDEX IF NOT EXISTS "{table}_snapshot_date" ON "{table}" (snapshot_date)')
+    if "Currency" in dataframe:
+        db_conn.execute(f'CREATE INDEX IF NOT EXISTS "{table}_currency_date" ON "{table}" (Currency, snapshot_date)')
+
+def load_to_db(transform_task_id = "converting_currencies", db_name = "bank_data.db", chunk_size = 1000,
+               merge_task_id = "merge_sources", **context):
+    """
+    Gets data from the intermediate file of the transform step and upserts it into the SQLite DB file
+    called bank_data.db which is stored on the parent directory of this python file (opt/airflow).
+    Rows are keyed on bank name (and currency for the long layout) plus the snapshot date of the DAG run,
+    so every daily run appends its snapshot to the history and a rerun of the same day just replaces it.
+    Rows are written with executemany in chunks of chunk_size rows, all of them on a single transaction.
+    Exact decimal runs are loaded into their own <table>_decimal table, whose value columns are declared TEXT,
+    as the column types of a table are set by the first run that creates it.
+    Once loaded, the fingerprints of the sources are stored so the next runs can tell if they changed,
+    and the intermediate files no longer needed are removed (see prune_intermediates).
+    """
+    transformed_data_df = read_intermediate(context, transform_task_id)
+    snapshot_date = context.get("ds") or datetime.now().strftime('%Y-%m-%d')
+    transformed_data_df.insert(1, "snapshot_date", snapshot_date)
+    table = "transformed_data_long" if "Currency" in transformed_data_df else "transformed_data"
+    if has_decimal_values(transformed_data_df):
+        table = f'{table}_decimal'
+    key_columns = ["Name", "Currency", "snapshot_date"] if "Currency" in transformed_data_df else ["Name", "snapshot_date"]
+
+    columns = list(transformed_data_df.columns)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    placeholders = ", ".join("?" for _ in columns)
+    conflict_keys = ", ".join(f'"{column}"' for column in key_columns)
+    assignments = ", ".join(f'"{column}" = excluded."{column}"' for column in columns if column not in key_columns)
+    upsert_query = f'INSERT INTO "{table}" ({column_list}) VALUES ({placeholders}) ON CONFLICT ({conflict_keys}) DO UPDATE SET {assignments}'
+    rows = transformed_data_df.astype(object).where(transformed_data_df.notna(), None).to_numpy().tolist()
+
+    db_conn = bank_db_conn(db_name)
+    try:
+        with db_conn:
+            prepare_snapshot_table(db_conn, table, transformed_data_df, key_columns)
+            for start in range(0, len(rows), chunk_size):
+                db_conn.executemany(upsert_query, rows[start:start + chunk_size])
+        print(f'{len(rows)} rows of {snapshot_date} loaded into {db_name} table {table}')
+    finally:
+        db_conn.close()
+    store_fingerprints(context, merge_task_id)
+    prune_intermediates(context)
 
 # Defining task operators
 
-bank_data_web_scraping = PythonOperator(task_id = "bank_data_web_scraping", python_callable = extract_bank_data, dag = dag)
-exchange_rate_file = PythonOperator(task_id = "get_exchange_rate", python_callable = extract_exchange_rate, dag = dag)
+source_manifest = PythonOperator(task_id = "read_source_manifest", python_callable = read_source_manifest, dag = dag)
+extracting_sources = PythonOperator.partial(task_id = "extract_source", python_callable = extract_source, dag = dag,
+                                            pool = extraction_settings["pool"],
+                                            max_active_tis_per_dag = extraction_settings["max_parallel_extracts"]
+                                            ).expand(op_kwargs = source_manifest.output)
+merging_sources = PythonOperator(task_id = "merge_sources", python_callable = merge_sources, dag = dag)
+sources_changed_gate = ShortCircuitOperator(task_id = "check_sources_changed", python_callable = sources_changed, dag = dag)
 transforming_data = PythonOperator(task_id = "converting_currencies", python_callable = transform, dag = dag)
 loading_to_sqlite = PythonOperator(task_id = "loading_to_DB", python_callable = load_to_db, dag = dag)
 
 # tasks dependencies/pipeline
 
-bank_data_web_scraping.set_downstream(transforming_data)
-exchange_rate_file.set_downstream(transforming_data)
+source_manifest.set_downstream(extracting_sources)
+extracting_sources.set_downstream(merging_sources)
+merging_sources.set_downstream(sources_changed_gate)
+sources_changed_gate.set_downstream(transforming_data)
 transforming_data.set_downstream(loading_to_sqlite)
@@ -1,85 +1,471 @@
-import requests
-import pandas as pd
-import numpy as np
 import re
 import json
+import time
+import os
+import hashlib
+import random
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from collections import OrderedDict
+import sys
+import argparse
+import importlib.util
 from datetime import datetime
-from bs4 import BeautifulSoup
-import matplotlib.pyplot as plt
+
+# requests, pandas, numpy, bs4 and matplotlib are imported inside the functions that need them,
+# so importing this module stays cheap and has no side effects
+
+# Settings of the shared HTTP client used by url_request
+http_settings = {
+    "connect_timeout": 5,
+    "read_timeout": 30,
+    "max_retries": 4,
+    "backoff": 0.5,
+    "max_retry_after": 60,
+    "pool_size": 32}
+retry_status_codes = (429, 500, 502, 503, 504)
+latency_buckets_ms = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf")]
+latency_histograms = {}
+transfer_stats = {"bytes": 0}
+http_lock = threading.Lock()
+http_session = None
+
+def configure_http_client(**settings):
+    """
+    This function updates the settings of the shared HTTP client (timeouts in seconds, retries, backoff,
+    longest Retry-After wait in seconds, pool size).
+    The pooled session is rebuilt on the next request.
+    """
+    global http_session
+    with http_lock:
+        http_settings.update(settings)
+        http_session = None
+
+def http_client():
+    """
+    This function returns the shared requests session. Its connections are kept alive and pooled,
+    so consecutive requests to the same host do not pay a new TCP and TLS handshake.
+    """
+    import requests
+    global http_session
+    with http_lock:
+        if http_session is None:
+            http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections = http_settings["pool_size"],
+                                                    pool_maxsize = http_settings["pool_size"])
+            http_session.mount("https://", adapter)
+            http_session.mount("http://", adapter)
+        return http_session
+
+def record_latency(url: str, seconds: float):
+    """
+    This function adds a request duration to the latency histogram of the url host
+    """
+    host = urlparse(url).netloc
+    milliseconds = seconds * 1000
+    bucket = next(index for index, upper_limit in enumerate(latency_buckets_ms) if milliseconds <= upper_limit)
+    with http_lock:
+        histogram = latency_histograms.setdefault(host, [0] * len(latency_buckets_ms))
+        histogram[bucket] += 1
+
+def latency_report():
+    """
+    This function returns a dataframe with the latency histogram of every requested host
+    (number of requests that took up to each bucket upper limit in milliseconds)
+    """
+    import pandas as pd
+    with http_lock:
+        rows = [(host, upper_limit, count) for host, histogram in latency_histograms.items()
+                for upper_limit, count in zip(latency_buckets_ms, histogram)]
+    return pd.DataFrame(rows, columns = ["host", "up_to_ms", "requests"])
+
+def http_get(url: str, headers: dict = None):
+    """
+    This function does a GET request to the given url and returns a response object.
+    Requests go through the shared pooled session with connect/read timeouts. Connection errors, timeouts and
+    429/5xx answers are retried with a jittered exponential backoff (or the Retry-After time sent by the server,
+    capped to max_retry_after seconds). The last answer is returned when every retry failed.
+    Returns None if the request could not be done.
+    """
+    import requests
+    session = http_client()
+    timeout = (http_settings["connect_timeout"], http_settings["read_timeout"])
+    request = None
+    for attempt in range(http_settings["max_retries"] + 1):
+        wait = random.uniform(0, http_settings["backoff"] * 2 ** attempt)
+        try:
+            start = time.perf_counter()
+            request = session.get(url, headers = headers, timeout = timeout)
+            record_latency(url, time.perf_counter() - start)
+            with http_lock:
+                transfer_stats["bytes"] += len(request.content)
+            if request.status_code not in retry_status_codes:
+                return request
+            retry_after = request.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                wait = min(float(retry_after), http_settings["max_retry_after"])
+        except requests.exceptions.ConnectionError as error:
+            print(f'Connection error ocurred. Check internet connection. Error: {error}')
+        except requests.exceptions.Timeout as error:
+            print(f'The request reached timeout. Error: {error}')
+        except requests.exceptions.RequestException as error:
+            print(f'An error ocurred. Error: {error}')
+            return None
+        if attempt < http_settings["max_retries"]:
+            time.sleep(wait)
+    return request
+
+# Settings of the on-disk response cache, disabled while directory is None
+cache_settings = {
+    "directory": None,
+    "ttl": 24 * 60 * 60,
+    "max_bytes": 50 * 1024 * 1024,
+    "offline": False}
+# Running index of the cached files {file name: size} from the least to the most recently used one and their total size,
+# so the cache directory is only listed once (by configure_response_cache) instead of on every write
+cache_index = OrderedDict()
+cache_size = {"bytes": 0}
+cache_lock = threading.Lock()
+
+def configure_response_cache(directory: str = None, ttl: float = 24 * 60 * 60, max_bytes: int = 50 * 1024 * 1024, offline: bool = False):
+    """
+    This function enables the on-disk response cache of url_request on the given directory (None disables it).
+    Cached responses younger than ttl seconds are used as they are, older ones are revalidated with the server.
+    The least recently used responses are removed when the cache grows over max_bytes.
+    With offline every response comes from the cache and the network is never used.
+    Files already on the directory are indexed by their modification time, which is kept as their last access time.
+    """
+    files = []
+    if directory is not None:
+        os.makedirs(directory, exist_ok = True)
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, name, stat.st_size))
+    with cache_lock:
+        cache_settings.update({"directory": directory, "ttl": ttl, "max_bytes": max_bytes, "offline": offline})
+        cache_index.clear()
+        cache_index.update((name, size) for _, name, size in sorted(files))
+        cache_size["bytes"] = sum(cache_index.values())
+
+def cache_file(url: str) -> str:
+    """
+    This function returns the path of the cache file of the given url
+    """
+    return os.path.join(cache_settings["directory"], hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+def read_cache_entry(url: str):
+    """
+    This function returns the cached entry (body, ETag, Last-Modified, stored time) of the url, None if not cached
+    """
+    path = cache_file(url)
+    try:
+        with open(path) as file:
+            entry = json.load(file)
+        os.utime(path)  # file modification time is used as last access time when the cache is indexed again
+    except (FileNotFoundError, json.JSONDecodeError):
+        # the file could also be evicted by another thread between the reads
+        return None
+    with cache_lock:
+        if os.path.basename(path) in cache_index:
+            cache_index.move_to_end(os.path.basename(path))
+    return entry
+
+def write_cache_entry(url: str, entry: dict):
+    """
+    This function stores the entry of the url on the cache and evicts the least recently used entries
+    when the cache is bigger than the configured max_bytes. Sizes are taken from the running index,
+    so the cost of a write does not grow with the number of cached files.
+    """
+    path = cache_file(url)
+    name = os.path.basename(path)
+    temporary_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temporary_path, "w") as file:
+        json.dump(entry, file)
+    size = os.path.getsize(temporary_path)
+    os.replace(temporary_path, path)
+    with cache_lock:
+        cache_size["bytes"] += size - cache_index.pop(name, 0)
+        cache_index[name] = size
+        while cache_size["bytes"] > cache_settings["max_bytes"] and cache_index:
+            evicted_name, evicted_size = cache_index.popitem(last = False)
+            cache_size["bytes"] -= evicted_size
+            try:
+                os.remove(os.path.join(cache_settings["directory"], evicted_name))
+            except FileNotFoundError:
+                pass
+
+def cached_response(url: str, entry: dict):
+    """
+    This function builds a response object from a cache entry
+    """
+    import requests
+    response = requests.Response()
+    response.url = url
+    response.status_code = 200
+    response.encoding = "utf-8"
+    response._content = entry["text"].encode("utf-8")
+    response.headers.update({key: value for key, value in [("ETag", entry["etag"]), ("Last-Modified", entry["last_modified"])] if value})
+    return response
 
 def url_request(url: str):
     """
     This function will do a request to the given url and return a response object
+    When the response cache is enabled (see configure_response_cache) fresh cached responses are returned
+    without using the network and stale ones are revalidated with a conditional GET (If-None-Match/If-Modified-Since).
+    Returns None if the request could not be done.
     """
-    try:
-        request = requests.get(url)
-    except requests.exceptions.ConnectionError as error:
-        print(f'Connection error ocurred. Check internet connection. Error: {error}')
-    except requests.exceptions.Timeout as error:
-        print(f'The request reached timeout. Error: {error}')
-    except requests.exceptions.HTTPError as error:
-        print(f'An HTTP error ocurred. Error: {error}')
-    except requests.exceptions.RequestException as error:
-        print(f'An error ocurred. Error: {error}')
+    if cache_settings["directory"] is None:
+        return http_get(url)
+    entry = read_cache_entry(url)
+    if entry is not None and (cache_settings["offline"] or time.time() - entry["stored_at"] < cache_settings["ttl"]):
+        return cached_response(url, entry)
+    if cache_settings["offline"]:
+        print(f'{url} is not cached and offline mode is enabled')
+        return None
+    headers = {}
+    if entry is not None and entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry is not None and entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    request = http_get(url, headers)
+    if request is not None and request.status_code == 304 and entry is not None:
+        entry["stored_at"] = time.time()
+        write_cache_entry(url, entry)
+        return cached_response(url, entry)
+    if request is not None and request.status_code == 200:
+        write_cache_entry(url, {"url": url,
+                                "etag": request.headers.get("ETag"),
+                                "last_modified": request.headers.get("Last-Modified"),
+                                "stored_at": time.time(),
+                                "text": request.text})
     return request
 
+# lxml is much faster than the pure python html.parser, which is kept as fallback when lxml is not installed
+html_parser = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+web_scraping_results = {}
+
+def scrape_resources(request) -> dict:
+    """
+    This function receives a response object of the pokeAPI docs page and gathers every documented endpoint.
+    Returns a dict {resource name: (url template, headers)} where headers is the list of (name, description, type)
+    tuples of the first table that follows the endpoint "GET" paragraph (its type table, e.g. Berry (type)).
+    Just the paragraphs and table bodies of the page are parsed, and results are memoized by the hash
+    of the page content, so scraping the same page again costs nothing.
+    """
+    from bs4 import BeautifulSoup, SoupStrainer
+    content_hash = hashlib.sha256(request.content).hexdigest()
+    if content_hash in web_scraping_results:
+        return {resource: (url_template, list(headers)) for resource, (url_template, headers) in web_scraping_results[content_hash].items()}
+    soup = BeautifulSoup(request.text, features = html_parser, parse_only = SoupStrainer(["p", "tbody"]))
+    resources = {}
+    resource = None
+    for element in soup.find_all(["p", "tbody"]):
+        if element.name == "p" and "GET http" in element.text:
+            pattern = r" .*"
+            url_template = re.search(pattern, element.text)[0].strip()
+            pattern = r"\{[\w ]+\}\/"
+            url_template = re.sub(pattern, r"", url_template)
+            resource = url_template.rstrip("/").rsplit("/", 1)[-1]
+        elif element.name == "tbody" and resource is not None:
+            headers = [tuple(cell.text.strip() for cell in row.find_all('td')[:3]) for row in element.find_all('tr')]
+            resources[resource] = (url_template, headers)
+            resource = None
+    web_scraping_results[content_hash] = resources
+    return {resource: (url_template, list(headers)) for resource, (url_template, headers) in resources.items()}
+
 def web_scraping(request):
     """
     This function receives a response object and parses the text on it to gather specific data
-    Returns the berry url template and a list of tupples with attribute names and descriptions
+    Returns the berry url template and a list of tupples with attribute names, descriptions and types
+    (see scrape_resources for the rest of the pokeAPI resources)
     """
-    soup = BeautifulSoup(request.text, features = "html.parser")
-    list_url_templates = []
-    paragraphs = soup.find_all('p')
-    for paragraph in paragraphs:
-        if "GET https://" in paragraph.text:
-            pattern = r" .*"
-            url_template = re.search(pattern, paragraph.text)[0].strip()
-            list_url_templates.append(url_template)
-            if "/berry/{" in url_template:
-                pattern = r"\{[\w ]+\}\/"
-                berry_url_template = re.sub(pattern, r"", url_template)
-    tables = soup.find_all('tbody')
-    rows = tables[2].find_all('tr')
-    list_name_desc = [(row.find_all('td')[0].text.strip(), row.find_all('td')[1].text.strip()) for row in rows]
+    berry_url_template, list_name_desc = scrape_resources(request)["berry"]
     return (berry_url_template, list_name_desc)
 
-def extracting_json(url, headers):
+def list_resource_urls(url: str, page_size: int = 100) -> list:
+    """
+    This function walks the paginated list endpoint of a pokeAPI resource (for example the berry url template)
+    and returns the url of every existing item, so the full id set is known before fetching any item.
+    """
+    resource_urls = []
+    page_url = f'{url}?limit={page_size}&offset=0'
+    while page_url:
+        page = fetch_json(page_url)
+        if page is None:
+            break
+        resource_urls.extend([result["url"] for result in page["results"]])
+        page_url = page["next"]
+    return resource_urls
+
+def fetch_json(url: str):
+    """
+    This function requests an url and returns its json data as a python dict. Rate limits and server errors
+    are already retried by url_request. Returns None if the data could not be retrieved.
+    """
+    response = url_request(url)
+    if response is None or response.status_code != 200:
+        status_code = None if response is None else response.status_code
+        print(f'Could not get data from {url}. Status code: {status_code}')
+        return None
+    return json.loads(response.text)
+
+def named_resource(value):
+    """
+    Projection of a NamedAPIResource attribute ({"name": ..., "url": ...}) to its name
+    """
+    return None if value is None else value["name"]
+
+def named_resource_list(value):
+    """
+    Projection of a list of NamedAPIResource attributes to the list of their names
+    """
+    return None if value is None else [resource["name"] for resource in value]
+
+def raw_value(value):
+    """
+    Projection that keeps the attribute as it comes on the json data
+    """
+    return value
+
+def projection_plan(headers: list) -> list:
+    """
+    This function compiles the headers of a resource (name, description, type) into a projection plan:
+    a list of (attribute, projection function, integer) tuples. NamedAPIResource attributes are projected to their
+    name, lists of them to a list of names and any other attribute is kept as it is. The plan is built once
+    per resource, so records are projected without checking the attribute names or types again.
+    """
+    plan = []
+    for header in headers:
+        value_type = header[2] if len(header) > 2 else ""
+        if value_type.startswith("NamedAPIResource"):
+            projection = named_resource
+        elif value_type.startswith("list NamedAPIResource"):
+            projection = named_resource_list
+        else:
+            projection = raw_value
+        plan.append((header[0], projection, value_type == "integer"))
+    return plan
+
+def new_column_buffers(plan: list, size: int) -> dict:
+    """
+    This function preallocates one array of size rows per attribute of the plan. Integer attributes are stored
+    on float arrays (NaN while missing) and the rest on object arrays.
+    """
+    import numpy as np
+    return {attribute: np.full(size, np.nan) if integer else np.full(size, None, dtype = object)
+            for attribute, _, integer in plan}
+
+def buffers_to_frame(plan: list, buffers: dict, found):
+    """
+    This function builds the dataframe of the rows found on the column buffers. Integer columns are turned back
+    to int64 (or the nullable Int64 type when some value is missing).
+    """
+    import pandas as pd
+    columns = {}
+    for attribute, _, integer in plan:
+        column = buffers[attribute][found]
+        if integer:
+            column = pd.Series(column).astype("Int64" if pd.isna(column).any() else "int64")
+        columns[attribute] = column
+    return pd.DataFrame(columns).infer_objects()
+
+def extract_resources(resources: dict, max_workers: int = 16) -> dict:
+    """
+    This function extracts several pokeAPI resources in one run. resources is a dict {name: (url template, headers)},
+    as returned by scrape_resources. Every item url is listed first from the paginated list endpoints, then all items
+    of all resources are requested once on a shared thread pool of max_workers threads.
+    Each json record is projected with the compiled plan of its resource straight into preallocated column buffers,
+    keeping the list endpoint order. Returns a dict {name: dataframe}.
+    """
+    import numpy as np
+    plans = {name: projection_plan(headers) for name, (url, headers) in resources.items()}
+    item_urls = {name: list_resource_urls(url) for name, (url, headers) in resources.items()}
+    buffers = {name: new_column_buffers(plans[name], len(item_urls[name])) for name in resources}
+    found = {name: np.zeros(len(item_urls[name]), dtype = bool) for name in resources}
+    jobs = [(name, position) for name in resources for position in range(len(item_urls[name]))]
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        for (name, position), data in zip(jobs, executor.map(fetch_json, [item_urls[name][position] for name, position in jobs])):
+            if data is None:
+                continue
+            columns = buffers[name]
+            for attribute, projection, _ in plans[name]:
+                columns[attribute][position] = projection(data.get(attribute))
+            found[name][position] = True
+    return {name: buffers_to_frame(plans[name], buffers[name], found[name]) for name in resources}
+
+def extracting_json(url, headers, max_workers: int = 16):
     """
     This function receives an url template that serves as base to construct the complete url
-    for each existing berry on the pokeAPI. Then gets all the json data as a string and casts
-    it to pyhton dict. Then creates each berry data dict is stored in a list to later populate
-    a dataframe which is returned.
-    """
-    berry_id = 1
-    json_request = url_request(f'{url}{berry_id}')
-    code = json_request.status_code
-    berry_dict = {}
-    list_berries = []
-    while code == 200:
-        json_request = url_request(f'{url}{berry_id}')
-        berry_data = json.loads(json_request.text)
-        for header in headers:
-            key = header[0]
-            if key in ["firmness", "item", "natural_gift_type"]:
-                berry_dict[key] = berry_data[key]["name"]
-            elif key == "flavors":
-                berry_dict[key] = str(berry_data[key])
-            else:
-                berry_dict[key] = berry_data[key]
-        list_berries.append(berry_dict.copy())
-        berry_id += 1
-        json_request = url_request(f'{url}{berry_id}')
-        code = json_request.status_code
-    berry_df = pd.DataFrame.from_dict(list_berries)
+    for each existing berry on the pokeAPI. The full list of berries is taken once from the paginated list
+    endpoint and then every berry json is requested exactly once, max_workers at a time on a thread pool.
+    Berries are projected into column buffers (see extract_resources) to populate a dataframe which is returned.
+    """
+    berry_df = extract_resources({"berry": (url, headers)}, max_workers)["berry"]
     return berry_df
 
-def transforming_data(dataframe):
+def new_growth_stats(keep_records: bool = True) -> dict:
     """
-    This function receives a dataframe in order to calculate the required statistics.
-    Then a new dataframe is generated and returned for the new calculations
+    This function returns an empty state for the online growth time statistics.
+    keep_records (the default) keeps the berry names and growth times lists, required by the berries_names and growth_times
+    columns, so the state grows with every berry. Pass keep_records=False to keep memory bounded by the number of distinct
+    growth times, those two columns are then left empty.
     """
+    return {"count": 0, "min": None, "max": None, "mean": 0.0, "m2": 0.0, "frequency": {},
+            "names": [] if keep_records else None, "growth_times": [] if keep_records else None}
 
+def update_growth_stats(stats: dict, dataframe) -> dict:
+    """
+    This function updates the growth time statistics state with a batch of berries.
+    Mean and variance are merged with the parallel version of Welford algorithm, min and max are compared
+    and the frequencies are added, so no record needs to be kept. The median is taken from the frequencies,
+    which only grow with the number of distinct growth times.
+    """
+    growth_times = dataframe["growth_time"].to_numpy()
+    if len(growth_times) == 0:
+        return stats
+    batch_count = len(growth_times)
+    batch_mean = growth_times.mean()
+    batch_m2 = ((growth_times - batch_mean) ** 2).sum()
+    total_count = stats["count"] + batch_count
+    delta = batch_mean - stats["mean"]
+    stats["mean"] += delta * batch_count / total_count
+    stats["m2"] += batch_m2 + delta ** 2 * stats["count"] * batch_count / total_count
+    stats["count"] = total_count
+    batch_min, batch_max = growth_times.min(), growth_times.max()
+    stats["min"] = batch_min if stats["min"] is None else min(stats["min"], batch_min)
+    stats["max"] = batch_max if stats["max"] is None else max(stats["max"], batch_max)
+    counts = dataframe["growth_time"].value_counts(sort = False)
+    for growth_time, count in zip(counts.index.tolist(), counts.tolist()):
+        stats["frequency"][growth_time] = stats["frequency"].get(growth_time, 0) + count
+    if stats["names"] is not None:
+        stats["names"].extend(dataframe["name"].tolist())
+        stats["growth_times"].extend(growth_times.tolist())
+    return stats
+
+def median_from_frequency(frequency: dict, count: int) -> float:
+    """
+    This function returns the median of a set of values given as a {value: frequency} dict
+    """
+    import numpy as np
+    values = np.array(sorted(frequency))
+    positions = np.cumsum([frequency[value] for value in values])
+    lower = values[np.searchsorted(positions, (count - 1) // 2, side = "right")]
+    upper = values[np.searchsorted(positions, count // 2, side = "right")]
+    return (lower + upper) / 2
+
+def growth_stats_frame(stats: dict):
+    """
+    This function generates the statistics dataframe (same layout as transforming_data) from the online state
+    """
+    import pandas as pd
     headers = ["berries_names",
                "growth_times",
                "min_growth_time",
@@ -88,30 +474,27 @@ def transforming_data(dataframe):
                "variance_growth_time",
                "mean_growth_time",
                "frequency_growth_time"]
-    
-    growth_time_list = dataframe["growth_time"].to_list()
-    berry_names = dataframe["name"].to_list()
-    min_growth_time = np.min(growth_time_list)
-    median_growth_time = np.median(growth_time_list)
-    max_growth_time = np.max(growth_time_list)
-    variance_growth_time = np.var(growth_time_list)
-    mean_growth_time = np.mean(growth_time_list)
-
-    frequency_growth_time = {}
-    for growth_time in growth_time_list:
-        frequency_growth_time[growth_time] = growth_time_list.count(growth_time)
-
-    calculations = [berry_names,
-                    growth_time_list,
-                    min_growth_time,
-                    median_growth_time, max_growth_time,
-                    variance_growth_time, mean_growth_time,
-                    frequency_growth_time]
-    
+
+    calculations = [stats["names"],
+                    stats["growth_times"],
+                    stats["min"],
+                    median_from_frequency(stats["frequency"], stats["count"]), stats["max"],
+                    stats["m2"] / stats["count"], stats["mean"],
+                    stats["frequency"]]
+
     records = dict(zip(headers, calculations))
     transformed_df = pd.DataFrame.from_dict([records])
     return transformed_df
 
+def transforming_data(dataframe):
+    """
+    This function receives a dataframe in order to calculate the required statistics.
+    Then a new dataframe is generated and returned for the new calculations
+    Statistics are computed on numpy arrays by the same engine used for streaming batches (update_growth_stats).
+    """
+    stats = update_growth_stats(new_growth_stats(), dataframe)
+    return growth_stats_frame(stats)
+
 def load_to_csv(dataframe, csv_file):
     """
     This function receives a dataframe and generates a CSV file from it for reporting purposes.
@@ -119,44 +502,219 @@ def load_to_csv(dataframe, csv_file):
     dataframe.to_csv(csv_file, index = False)
     return dataframe
 
-def log_progress(message: str, log_file: str):
+def flatten_flavors(dataframe):
+    """
+    This function turns the nested flavors column of the berries dataframe ([{"potency": 10, "flavor": {"name": "spicy", ...}}, ...])
+    into one integer column per flavor (flavor_spicy, flavor_dry, ...) holding its potency, and keeps the flavors
+    column as a list of {"flavor", "potency"} records, which is stored as a list of structs on columnar files.
+    """
+    import pandas as pd
+    flavors = [[{"flavor": flavor["flavor"]["name"], "potency": flavor["potency"]} for flavor in berry_flavors]
+               for berry_flavors in dataframe["flavors"]]
+    potencies = pd.DataFrame([{f'flavor_{flavor["flavor"]}': flavor["potency"] for flavor in berry_flavors}
+                              for berry_flavors in flavors], index = dataframe.index)
+    flattened_df = dataframe.assign(flavors = flavors)
+    return pd.concat([flattened_df, potencies.fillna(0).astype("int64")], axis = 1)
+
+def load_to_columnar(dataframe, output_file, file_format: str = "parquet", compression: str = "zstd"):
+    """
+    This function receives a dataframe and generates a compressed columnar file from it (Parquet, or Arrow IPC/Feather
+    with file_format="feather"), so readers can memory-map it and read just the columns they need.
+    Nested flavors are flattened (see flatten_flavors), repeated text columns are dictionary encoded
+    and dict columns are stored as lists of {"key", "value"} records. Requires pyarrow.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+
+    columnar_df = dataframe
+    if "flavors" in columnar_df and len(columnar_df) and isinstance(columnar_df["flavors"].iloc[0], list):
+        columnar_df = flatten_flavors(columnar_df)
+    columnar_df = columnar_df.assign(**{column: columnar_df[column].astype("category")
+                                        for column in ["firmness", "item", "natural_gift_type"] if column in columnar_df})
+    columnar_df = columnar_df.assign(**{column: [[{"key": key, "value": value} for key, value in cell.items()] for cell in columnar_df[column]]
+                                        for column in columnar_df if len(columnar_df) and isinstance(columnar_df[column].iloc[0], dict)})
+    table = pa.Table.from_pandas(columnar_df, preserve_index = False)
+    if file_format == "parquet":
+        pq.write_table(table, output_file, compression = compression)
+    elif file_format == "feather":
+        feather.write_feather(table, output_file, compression = compression)
+    else:
+        raise ValueError(f'Unknown file format {file_format}. Use "parquet" or "feather"')
+    return dataframe
+
+# Settings of the structured stage log, records are kept on a buffer and written to log_file every buffer_size records
+stage_log_settings = {
+    "log_file": "stage_log.jsonl",
+    "buffer_size": 32}
+stage_log_buffer = []
+stage_log_lock = threading.Lock()
+
+def configure_stage_log(log_file: str = "stage_log.jsonl", buffer_size: int = 32):
+    """
+    This function sets the JSON lines file the stage records are written to and how many records are buffered
+    before writing them. Pending records of the previous file are written first.
+    """
+    flush_stage_log()
+    stage_log_settings.update({"log_file": log_file, "buffer_size": buffer_size})
+
+def flush_stage_log():
     """
-    This function generates a txt faile that contains records with a timestamp for each stage of the process
+    This function appends the buffered stage records to the log file with a single write
     """
-    print(message)
-    timestamp_format = '%Y-%h-%d-%H:%M:%S' # Year-Monthname-Day-Hour-Minute-Second 
-    current_time = datetime.now() # get current timestamp 
-    timestamp = current_time.strftime(timestamp_format)
-    with open(log_file, "a") as logging_file:
-        logging_file.write(timestamp + ',' + message + '\n')
+    with stage_log_lock:
+        records = stage_log_buffer[:]
+        stage_log_buffer.clear()
+    if records:
+        with open(stage_log_settings["log_file"], "a") as logging_file:
+            logging_file.write("".join(json.dumps(record) + "\n" for record in records))
 
-poke_url = "https://pokeapi.co/docs/v2#berries-section"
-stats_output_file = "poke-API_statistics.csv"
-raw_output_file = "all_berries_data.csv"
-log_file = "log_file.txt"
+def peak_rss_mb():
+    """
+    This function returns the peak resident memory of the process in MB, None where it is not available (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes on Linux
+    return round(peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
 
-log_progress("Requesting data to pokeAPI", log_file)
-api_request = url_request(poke_url)
+@contextmanager
+def log_stage(stage: str, message: str = None):
+    """
+    This context manager times a stage of the process and buffers a JSON lines record with the stage name,
+    start and end timestamps, duration, rows, bytes transferred over HTTP and peak memory of the process.
+    The record dict is yielded so the stage can set its rows, for example:
 
-log_progress("Performing some web scraping to gather data...", log_file)
-berry_url_template = web_scraping(api_request)[0]
-headers = web_scraping(api_request)[1]
+        with log_stage("transforming_data") as record:
+            transformed_df = transforming_data(berry_df)
+            record["rows"] = len(transformed_df)
 
-log_progress("Extracting juice from berries...", log_file)
-berry_df = extracting_json(berry_url_template, headers)
+    It can also decorate a function, see logged_stage to fill the rows from its result.
+    """
+    if message is not None:
+        print(message)
+    record = {"stage": stage, "start": datetime.now().isoformat(timespec = "milliseconds"), "end": None,
+              "duration_s": None, "rows": None, "bytes": None, "peak_rss_mb": None, "status": "ok"}
+    start_bytes = transfer_stats["bytes"]
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record["status"] = "error"
+        raise
+    finally:
+        record["duration_s"] = round(time.perf_counter() - start, 6)
+        record["end"] = datetime.now().isoformat(timespec = "milliseconds")
+        record["bytes"] = transfer_stats["bytes"] - start_bytes
+        record["peak_rss_mb"] = peak_rss_mb()
+        with stage_log_lock:
+            stage_log_buffer.append(record)
+            full = len(stage_log_buffer) >= stage_log_settings["buffer_size"]
+        if full:
+            flush_stage_log()
 
-log_progress("Transforming berries data", log_file)
-transfromed_berry_df = transforming_data(berry_df)
+def logged_stage(stage: str, rows = len):
+    """
+    This decorator logs every call of the decorated function as a stage (see log_stage).
+    rows is applied to the returned value to get the rows of the record, None leaves them empty.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with log_stage(stage) as record:
+                result = function(*args, **kwargs)
+                if rows is not None and result is not None:
+                    record["rows"] = rows(result)
+            return result
+        return wrapper
+    return decorator
+
+def plot_histogram(transformed_df, output_file: str = None, show: bool = False):
+    """
+    This function plots the histogram of the growth time frequencies of the transformed dataframe.
+    The figure is saved to output_file when given, and only shown on screen when show is True,
+    otherwise it is drawn without any GUI backend so it also works on headless servers.
+    """
+    frequency = transformed_df['frequency_growth_time'].values[0]
+    if show:
+        import matplotlib.pyplot as plt
+        figure = plt.figure(figsize=(8, 6))
+    else:
+        from matplotlib.figure import Figure
+        figure = Figure(figsize=(8, 6))
+    axes = figure.subplots()
+    axes.hist(frequency.keys(), weights=frequency.values(), bins=len(frequency))
+    axes.set_title('Frequency of Growth Time')
+    axes.set_xlabel('Growth Time')
+    axes.set_ylabel('Frequency')
+    axes.grid(True)
+    if output_file is not None:
+        figure.savefig(output_file)
+    if show:
+        plt.show()
+    return figure
+
+def main(arguments: list = None):
+    """
+    Command line entry point that runs the whole pokeAPI berries pipeline
+    """
+    parser = argparse.ArgumentParser(description = "Extracts berries data from pokeAPI and generates their statistics")
+    parser.add_argument("--url", default = "https://pokeapi.co/docs/v2#berries-section", help = "pokeAPI docs page")
+    parser.add_argument("--stats-file", default = "poke-API_statistics.csv")
+    parser.add_argument("--raw-file", default = "all_berries_data.csv")
+    parser.add_argument("--columnar-file", default = "all_berries_data.parquet", help = "Parquet copy of the raw data, skipped without pyarrow")
+    parser.add_argument("--histogram-file", default = "growth_time_histogram.png")
+    parser.add_argument("--show", action = "store_true", help = "show the histogram on screen")
+    parser.add_argument("--log-file", default = "stage_log.jsonl", help = "JSON lines file with the timing of every stage")
+    parser.add_argument("--cache-dir", default = ".http_cache", help = "directory of the HTTP response cache")
+    parser.add_argument("--offline", action = "store_true", help = "use only cached responses")
+    parser.add_argument("--extra-resources", nargs = "*", default = [],
+                        help = "other pokeAPI resources extracted on the same run to all_<resource>_data.csv, e.g. item pokemon")
+    options = parser.parse_args(arguments)
+
+    configure_response_cache(options.cache_dir, offline = options.offline)
+    configure_stage_log(options.log_file)
+
+    try:
+        with log_stage("url_request", "Requesting data to pokeAPI") as record:
+            api_request = url_request(options.url)
+            record["rows"] = 1
+
+        with log_stage("web_scraping", "Performing some web scraping to gather data...") as record:
+            resources = scrape_resources(api_request)
+            record["rows"] = len(resources)
+        for resource in options.extra_resources:
+            if resource not in resources:
+                print(f'{resource} is not documented on {options.url}, it will not be extracted')
+
+        with log_stage("extracting_json", "Extracting juice from berries...") as record:
+            dataframes = extract_resources({resource: resources[resource] for resource in ["berry"] + options.extra_resources
+                                            if resource in resources})
+            berry_df = dataframes.pop("berry")
+            record["rows"] = len(berry_df) + sum(len(dataframe) for dataframe in dataframes.values())
+
+        with log_stage("transforming_data", "Transforming berries data") as record:
+            transfromed_berry_df = transforming_data(berry_df)
+            record["rows"] = len(transfromed_berry_df)
+
+        with log_stage("load_to_csv", "Generating CSV file") as record:
+            load_to_csv(transfromed_berry_df, options.stats_file)
+            print(load_to_csv(berry_df, options.raw_file))
+            if importlib.util.find_spec("pyarrow") is None:
+                print(f'pyarrow is not installed, {options.columnar_file} will not be generated')
+            else:
+                load_to_columnar(berry_df, options.columnar_file)
+            for resource, dataframe in dataframes.items():
+                load_to_csv(dataframe, f'all_{resource}_data.csv')
+            record["rows"] = len(berry_df) + sum(len(dataframe) for dataframe in dataframes.values())
 
-log_progress("Generating CSV file", log_file)
-load_to_csv(transfromed_berry_df, stats_output_file)
-print(load_to_csv(berry_df, raw_output_file))
+        with log_stage("plot_histogram", "Ploting Histogram"):
+            plot_histogram(transfromed_berry_df, options.histogram_file, options.show)
+    finally:
+        flush_stage_log()
 
-log_progress("Ploting Histogram", log_file)
-plt.figure(figsize=(8, 6))
-plt.hist(transfromed_berry_df['frequency_growth_time'].values[0].keys(), weights=transfromed_berry_df['frequency_growth_time'].values[0].values(), bins=len(transfromed_berry_df['frequency_growth_time'].values[0]))
-plt.title('Frequency of Growth Time')
-plt.xlabel('Growth Time')
-plt.ylabel('Frequency')
-plt.grid(True)
-plt.show()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
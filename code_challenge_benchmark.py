@@ -0,0 +1,118 @@
+import argparse
+import io
+import os
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+import pandas as pd
+from code_challenge_sql_and_etl import (sqlite_conn, db_cursor, db_backend, create_database, create_sales_table,
+                                        create_product_table, create_transformed_sales_table, generate_sales_chunks,
+                                        generate_product_chunks, populate_sales_table, populate_product_table,
+                                        top_product_specs, total_distinct_products_sold,
+                                        max_sales_category, revenue_range_from_db, stream_data_from_db, transform_data,
+                                        load_data, configure_query_cache)
+
+def timed(function, *args, **kwargs):
+    """
+    Runs the given function silencing its progress prints and returns its result and the elapsed seconds
+    """
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def drain(records) -> int:
+    """
+    Consumes an iterable without keeping its rows and returns how many rows it had
+    """
+    return sum(1 for _ in records)
+
+def run_benchmark(connection, db_name: str, rows: int, chunk_size: int = 50000, product_count: int = 1000, seed: int = 1) -> pd.DataFrame:
+    """
+    Times every stage of the SQL and ETL challenge (generate, populate, aggregate queries, extract, transform and load)
+    over rows random sales on the given connection (any supported backend).
+    Returns a dataframe with the seconds and throughput (rows per second) of each stage.
+    """
+    cursor = db_cursor(connection)
+    configure_query_cache()
+    timings = []
+
+    generated, seconds = timed(drain, generate_sales_chunks(rows, chunk_size, product_count, seed = seed))
+    timings.append(("generate", generated, seconds))
+
+    with redirect_stdout(io.StringIO()):
+        create_database(connection, cursor, db_name)
+        create_sales_table(connection, cursor, db_name)
+        create_product_table(connection, cursor, db_name)
+        create_transformed_sales_table(connection, cursor, db_name)
+    # populate timing includes the generation of the rows, which are streamed into the loader, and the summaries refresh
+    report, seconds = timed(populate_sales_table, generate_sales_chunks(rows, chunk_size, product_count, seed = seed),
+                            cursor, connection, db_name, chunk_size = chunk_size)
+    product_report, product_seconds = timed(populate_product_table, generate_product_chunks(product_count, chunk_size, seed = seed),
+                                            cursor, connection, db_name, chunk_size = chunk_size)
+    timings.append(("populate", report["loaded_rows"] + product_report["loaded_rows"], seconds + product_seconds))
+
+    aggregate_seconds = 0
+    for query_function in [top_product_specs, total_distinct_products_sold, max_sales_category]:
+        _, seconds = timed(query_function, cursor, db_name)
+        aggregate_seconds += seconds
+    timings.append(("aggregate queries", rows, aggregate_seconds))
+
+    # extract, transform and load run chunk by chunk as in streaming_etl, timing each stage apart
+    extract_seconds = transform_seconds = load_seconds = 0
+    extracted_rows = loaded_rows = 0
+    revenue_range, extract_seconds = timed(revenue_range_from_db, cursor, db_name)
+    chunks = stream_data_from_db(connection, db_name, chunk_size)
+    while True:
+        chunk, seconds = timed(next, chunks, None)
+        extract_seconds += seconds
+        if chunk is None:
+            break
+        extracted_rows += len(chunk)
+        (_, transformed_rows), seconds = timed(transform_data, chunk, revenue_range)
+        transform_seconds += seconds
+        report, seconds = timed(load_data, transformed_rows, cursor, connection, db_name, chunk_size = chunk_size)
+        load_seconds += seconds
+        loaded_rows += report["loaded_rows"]
+    timings.append(("extract", extracted_rows, extract_seconds))
+    timings.append(("transform", extracted_rows, transform_seconds))
+    timings.append(("load", loaded_rows, load_seconds))
+    cursor.close()
+
+    results = pd.DataFrame(timings, columns = ["stage", "rows", "seconds"])
+    results["rows_per_second"] = (results["rows"] / results["seconds"]).round(0)
+    results.insert(0, "backend", db_backend(connection)["name"])
+    results.insert(1, "sales_rows", rows)
+    return results
+
+def main():
+    """
+    Benchmarks the ETL on the embedded SQLite engine for every requested size and appends the results to a CSV file
+    """
+    parser = argparse.ArgumentParser(description = "Benchmark of the SQL and ETL challenge stages on SQLite")
+    parser.add_argument("--rows", type = int, nargs = "+", default = [10**4, 10**5, 10**6],
+                        help = "sales table sizes to benchmark, e.g. --rows 10000 100000 1000000 10000000")
+    parser.add_argument("--chunk-size", type = int, default = 50000)
+    parser.add_argument("--product-count", type = int, default = 1000)
+    parser.add_argument("--database-dir", default = None, help = "directory for the SQLite files, in memory when omitted")
+    parser.add_argument("--output", default = "benchmark_results.csv")
+    arguments = parser.parse_args()
+
+    all_results = []
+    for rows in arguments.rows:
+        connection = sqlite_conn(arguments.database_dir)
+        db_name = f'benchmark_{rows}'
+        if arguments.database_dir is not None:
+            database_file = os.path.join(arguments.database_dir, f'{db_name}.db')
+            if os.path.exists(database_file):
+                os.remove(database_file)
+        results = run_benchmark(connection, db_name, rows, arguments.chunk_size, arguments.product_count)
+        connection.close()
+        print(results.to_string(index = False))
+        all_results.append(results)
+    report = pd.concat(all_results)
+    report.insert(0, "run_at", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    report.to_csv(arguments.output, mode = "a", header = not os.path.exists(arguments.output), index = False)
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,34 @@
 import mysql.connector as conn
+import sqlite3
 import random
+import csv
+import json
+import os
+import tempfile
+import glob
+from datetime import datetime
+from itertools import islice
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from functools import wraps
+import threading
+import numpy as np
 import pandas as pd
 
-def db_conn(host_id: str, user_id: str, psw: str):
+def db_conn(host_id: str, user_id: str, psw: str, allow_local_infile: bool = False):
     """
     Handles the connection to a MySQL server to "sales" Data Base
     Receives DB connection credentials in order to connect to DB.
+    allow_local_infile must be True in order to use the LOAD DATA LOCAL INFILE path of bulk_load
     """
     try:
         connection = conn.connect(
             host = host_id,
             # database = db_name,
             user = user_id,
-            password = psw)
+            password = psw,
+            allow_local_infile = allow_local_infile)
     except conn.errors.DatabaseError as error:
         if "2003" in  str(error):
             return print(f'An exception has occurred: {error}. Server is not reachable')
@@ -27,6 +43,69 @@ def db_conn(host_id: str, user_id: str, psw: str):
             return print(f'An exception has occurred: {error}.')
     return connection
 
+class SQLiteConnection(sqlite3.Connection):
+    """
+    sqlite3 connection that remembers the directory where the DB files attached by create_database are stored.
+    None keeps every DB in memory.
+    """
+    database_dir = None
+
+def sqlite_conn(database_dir: str = None):
+    """
+    Handles the connection to the embedded SQLite engine, used to run and benchmark the ETL without a MySQL server.
+    Each db_name is attached as its own schema by create_database, so every query works unchanged as db_name.table
+    """
+    connection = sqlite3.connect(":memory:", factory = SQLiteConnection, check_same_thread = False)
+    connection.database_dir = database_dir
+    return connection
+
+# SQL differences between the supported backends
+mysql_backend = {
+    "name": "mysql",
+    "placeholder": "%s",
+    "errors": conn.errors.Error,
+    "table_options": "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin",
+    "auto_increment": "int NOT NULL AUTO_INCREMENT",
+    "upsert": "ON DUPLICATE KEY UPDATE {assignments}",
+    "new_value": "VALUES({column})",
+    "truncate": "TRUNCATE TABLE",
+    "explain": "EXPLAIN"}
+
+sqlite_backend = {
+    "name": "sqlite",
+    "placeholder": "?",
+    "errors": sqlite3.Error,
+    "table_options": "",
+    "auto_increment": "INTEGER NOT NULL",
+    "upsert": "ON CONFLICT ({keys}) DO UPDATE SET {assignments}",
+    "new_value": "excluded.{column}",
+    "truncate": "DELETE FROM",
+    "explain": "EXPLAIN QUERY PLAN"}
+
+# errors raised by each backend when creating a table that already exists
+table_exists_errors = (conn.errors.ProgrammingError, sqlite3.OperationalError)
+
+def db_backend(db_object) -> dict:
+    """
+    Returns the backend settings that match the given connection or cursor
+    """
+    if isinstance(db_object, (sqlite3.Connection, sqlite3.Cursor)):
+        return sqlite_backend
+    return mysql_backend
+
+def upsert_clause(backend: dict, key_columns: tuple, assignments: list) -> str:
+    """
+    Builds the clause that turns an INSERT into an upsert on the given backend.
+    assignments are "column = expression" strings where {column} values of the new row are written with new_value
+    """
+    return backend["upsert"].format(keys = ", ".join(key_columns), assignments = ", ".join(assignments))
+
+def new_value(backend: dict, column: str) -> str:
+    """
+    Expression that references the value of a column on the row being upserted
+    """
+    return backend["new_value"].format(column = column)
+
 def db_cursor(db_connection):
     """
     Generates a cursos object in order to handle queries to "sales" Data Base
@@ -34,10 +113,182 @@ def db_cursor(db_connection):
     cursor = db_connection.cursor()
     return cursor
 
+def db_pool(host_id: str, user_id: str, psw: str, pool_size: int = 5, pool_name: str = "sales_pool"):
+    """
+    Generates a pool of reusable connections to the MySQL server, so concurrent tasks do not pay a new connection each.
+    Receives DB connection credentials in order to connect to DB.
+    """
+    try:
+        pool = conn.pooling.MySQLConnectionPool(
+            pool_name = pool_name,
+            pool_size = pool_size,
+            host = host_id,
+            user = user_id,
+            password = psw)
+    except conn.errors.DatabaseError as error:
+        if "2003" in  str(error):
+            return print(f'An exception has occurred: {error}. Server is not reachable')
+        elif "1045" in str(error):
+            return print(f'An exception has occurred: {error}. Any of the provided credentials is incorrect')
+        else:
+            return print(f'An exception has occurred: {error}.')
+    return pool
+
+@contextmanager
+def pooled_cursor(pool):
+    """
+    Borrows a connection from the pool and yields a cursor on it.
+    The cursor is closed and the connection returned to the pool when the block ends.
+    """
+    connection = pool.get_connection()
+    cursor = db_cursor(connection)
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+        connection.close()
+
+def run_concurrent_queries(pool, db_name: str, query_functions: list, max_workers: int = None) -> dict:
+    """
+    Executes independent read query functions (like top_product_specs or max_sales_category, which receive cursor and db_name)
+    concurrently on a thread pool, each one on its own pooled connection.
+    max_workers is capped to the pool size, as the pool raises PoolError when every connection is borrowed.
+    Returns a dict with the function name as key and the returned dataframe as value.
+    """
+    def run_query(query_function):
+        with pooled_cursor(pool) as cursor:
+            return query_function(cursor, db_name)
+
+    max_workers = min(max_workers or pool.pool_size, pool.pool_size)
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        futures = {query_function.__name__: executor.submit(run_query, query_function) for query_function in query_functions}
+    return {name: future.result() for name, future in futures.items()}
+
+# Results of the analytical queries are cached by (function, db_name, data version).
+# The data version is read from the DB itself (see data_version), so writes done by any process or connection invalidate cached results
+query_cache = OrderedDict()
+query_cache_settings = {"max_entries": 32, "disk_dir": None}
+query_cache_stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+query_cache_lock = threading.Lock()
+
+def configure_query_cache(max_entries: int = 32, disk_dir: str = None):
+    """
+    Sets the size of the in-memory LRU cache and optionally a directory for the on-disk Parquet tier.
+    Cached files are named after the data version of their DB, so they stay valid between runs until the data changes.
+    """
+    with query_cache_lock:
+        query_cache.clear()
+        query_cache_settings["max_entries"] = max_entries
+        query_cache_settings["disk_dir"] = disk_dir
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok = True)
+
+def data_version(cursor, db_name: str):
+    """
+    Returns the version of the data of db_name as a (write counter, max sale_id) tupple.
+    The write counter is kept on the data_version table and bumped on every write done by this module (see invalidate_query_cache),
+    the max sale_id also catches rows inserted into sales by any other mean. Returns None when the tables are not created yet.
+    """
+    query = f"SELECT\
+                (SELECT version FROM {db_name}.data_version WHERE name = 'tables'),\
+                (SELECT MAX(sale_id) FROM {db_name}.sales)"
+    try:
+        cursor.execute(query)
+        writes, high_sale_id = cursor.fetchall()[0]
+    except db_backend(cursor)["errors"]:
+        return None
+    return writes or 0, high_sale_id or 0
+
+def invalidate_query_cache(db_connection, cursor, db_name: str):
+    """
+    Bumps the data version of the given DB (stored on the DB), so cached results of its queries are not used anymore
+    by this or any other process. Cached results of db_name are removed from memory and from the disk tier.
+    """
+    backend = db_backend(db_connection)
+    version_upsert = upsert_clause(backend, ("name",), ["version = version + 1"])
+    version_query = f"INSERT INTO {db_name}.data_version (name, version) VALUES ('tables', 1) {version_upsert}"
+    try:
+        cursor.execute(version_query)
+    except backend["errors"]:
+        # first write on the DB, the table is created once instead of on every write
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {db_name}.data_version (\
+                            name varchar(128) NOT NULL,\
+                            version int NOT NULL,\
+                            PRIMARY KEY (name)\
+                        ) {backend["table_options"]}')
+        cursor.execute(version_query)
+    db_connection.commit()
+    with query_cache_lock:
+        for key in [key for key in query_cache if key[1] == db_name]:
+            del query_cache[key]
+        disk_dir = query_cache_settings["disk_dir"]
+        if disk_dir is not None:
+            for stale_file in glob.glob(os.path.join(disk_dir, f'*-{db_name}-*.parquet')):
+                try:
+                    os.remove(stale_file)
+                except FileNotFoundError:
+                    pass
+
+def cached_query(query_function):
+    """
+    Decorator for query functions that receive (cursor, db_name) and return a dataframe.
+    Results are served from the in-memory LRU cache, then from the on-disk Parquet tier (when configured)
+    and only hit the DB on a miss. Hits and misses are counted on query_cache_stats.
+    Every call reads the data version of the DB first (one small query), when it is not available the query is not cached.
+    """
+    @wraps(query_function)
+    def wrapper(cursor, db_name: str):
+        version = data_version(cursor, db_name)
+        if version is None:
+            return query_function(cursor, db_name)
+        with query_cache_lock:
+            key = (query_function.__name__, db_name, version)
+            disk_dir = query_cache_settings["disk_dir"]
+            if key in query_cache:
+                query_cache.move_to_end(key)
+                query_cache_stats["hits"] += 1
+                return query_cache[key].copy()
+        disk_file = None
+        dataframe = None
+        if disk_dir is not None:
+            disk_file = os.path.join(disk_dir, f'{key[0]}-{db_name}-{version[0]}-{version[1]}.parquet')
+            try:
+                dataframe = pd.read_parquet(disk_file)
+            except (FileNotFoundError, ImportError):
+                dataframe = None
+        with query_cache_lock:
+            if dataframe is None:
+                query_cache_stats["misses"] += 1
+            else:
+                query_cache_stats["disk_hits"] += 1
+        if dataframe is None:
+            dataframe = query_function(cursor, db_name)
+            if disk_file is not None:
+                try:
+                    dataframe.to_parquet(disk_file, index = False)
+                except ImportError as error:
+                    print(f'Parquet cache tier is not available. Error: {error}')
+        with query_cache_lock:
+            query_cache[key] = dataframe
+            query_cache.move_to_end(key)
+            while len(query_cache) > query_cache_settings["max_entries"]:
+                query_cache.popitem(last = False)
+        return dataframe.copy()
+    return wrapper
+
 def create_database(db_connection, cursor, db_name: str):
     """
     Creates sales DB
+    On SQLite the DB is attached as a schema, stored as db_name.db on the connection database_dir (or in memory)
     """
+    if db_backend(db_connection)["name"] == "sqlite":
+        attached = [row[1] for row in cursor.execute('PRAGMA database_list').fetchall()]
+        if db_name not in attached:
+            database_dir = db_connection.database_dir
+            database_file = ":memory:" if database_dir is None else os.path.join(database_dir, f'{db_name}.db')
+            cursor.execute(f"ATTACH DATABASE '{database_file}' AS {db_name}")
+        print(f'Creating Data Base')
+        return None
     query = f'CREATE DATABASE IF NOT EXISTS {db_name}\
         CHARACTER SET=utf8mb4\
         COLLATE=utf8mb4_bin\
@@ -46,32 +297,86 @@ def create_database(db_connection, cursor, db_name: str):
     print(f'Creating Data Base')
     db_connection.commit()
 
-def create_sales_table(db_connection, cursor, db_name: str):
+def sales_table_query(db_name: str, indexes: bool = True, partition_by: str = None, partition_values: list = None,
+                      backend: dict = mysql_backend) -> str:
     """
-    Creates a table "sales" on the  Data base
+    Builds the CREATE TABLE query of the "sales" table.
+    indexes adds secondary indexes on (country, category) and product_id, used by the GROUP BY queries and the product join.
+    partition_by can be "country" (LIST partitions, one per country in partition_values) or "date"
+    (RANGE partitions on loaded_at, one per boundary date 'YYYY-MM-DD' in partition_values plus a last catch-all partition).
+    MySQL requires the partitioning column to be part of the primary key, so it is added to it when partitioning.
+    SQLite does not support partitions and its indexes are created apart (see sales_index_queries).
     """
-    try:
-        query = f'CREATE TABLE {db_name}.sales (\
+    primary_key = "sale_id"
+    partitions = ""
+    if backend["name"] == "sqlite" and partition_by is not None:
+        raise ValueError('Partitioning is not supported on SQLite')
+    if partition_by == "country":
+        primary_key = "sale_id, country"
+        countries = partition_values or ["Mexico", "Canada", "US"]
+        partition_list = ", ".join([f"PARTITION p_{index} VALUES IN ('{country}')" for index, country in enumerate(countries)])
+        partitions = f'PARTITION BY LIST COLUMNS(country) ({partition_list})'
+    elif partition_by == "date":
+        primary_key = "sale_id, loaded_at"
+        boundaries = partition_values or []
+        partition_list = [f"PARTITION p_{boundary.replace('-', '')} VALUES LESS THAN (UNIX_TIMESTAMP('{boundary}'))" for boundary in boundaries]
+        partition_list.append("PARTITION p_max VALUES LESS THAN MAXVALUE")
+        partitions = f'PARTITION BY RANGE (UNIX_TIMESTAMP(loaded_at)) ({", ".join(partition_list)})'
+    elif partition_by is not None:
+        raise ValueError(f'Unknown partitioning {partition_by}. Use "country" or "date"')
+    secondary_indexes = ""
+    if indexes and backend["name"] == "mysql":
+        secondary_indexes = ",\
+            INDEX idx_country_category (country, category),\
+            INDEX idx_product_id (product_id)"
+    query = f'CREATE TABLE {db_name}.sales (\
+            sale_id {backend["auto_increment"]},\
             product_id int NOT NULL ,\
             country varchar(256) NOT NULL,\
             category varchar(128) NOT NULL,\
             price double NOT NULL,\
             quantity int NOT NULL,\
-            final_sales double NOT NULL\
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin'
-        
-        cursor.execute(query)
+            final_sales double NOT NULL,\
+            loaded_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,\
+            PRIMARY KEY ({primary_key}){secondary_indexes}\
+        ) {backend["table_options"]} {partitions}'
+    return query
+
+def sales_index_queries(db_name: str) -> list:
+    """
+    SQLite version of the secondary indexes of the "sales" table, which can not be declared on CREATE TABLE
+    """
+    return [f'CREATE INDEX IF NOT EXISTS {db_name}.idx_country_category ON sales (country, category)',
+            f'CREATE INDEX IF NOT EXISTS {db_name}.idx_product_id ON sales (product_id)']
+
+def create_sales_table(db_connection, cursor, db_name: str, indexes: bool = True, partition_by: str = None, partition_values: list = None):
+    """
+    Creates a table "sales" on the  Data base
+    sale_id and loaded_at are filled by the DB on insert and are used as high-water mark for incremental loads
+    Schema options are described on sales_table_query
+    Every time the table is (re)created its summaries and watermarks are reset, as sale_id starts over
+    """
+    backend = db_backend(db_connection)
+    queries = [sales_table_query(db_name, indexes, partition_by, partition_values, backend)]
+    if indexes and backend["name"] == "sqlite":
+        queries += sales_index_queries(db_name)
+    try:
+        for query in queries:
+            cursor.execute(query)
         print(f'Creating sales table')
         db_connection.commit()
-    except conn.errors.ProgrammingError as error:
+        reset_sales_summaries(db_connection, cursor, db_name)
+    except table_exists_errors as error:
         print(f'An exception has ocurred: {error}')
         response = input(f'Do you want to remove existing table and create a new one? (yes/no) ')
         if response.lower() == "yes":
             drop_query = f'DROP TABLE {db_name}.sales'
             cursor.execute(drop_query)
             db_connection.commit()
-            cursor.execute(query)
+            for query in queries:
+                cursor.execute(query)
             db_connection.commit()
+            reset_sales_summaries(db_connection, cursor, db_name)
             return print("New table sales has been created")
         else:
             return print("Keep exisitng sales table")
@@ -90,67 +395,168 @@ def generate_sales_data() -> list:
     id_list = list(set([row[0] for row in list_of_rows]))
     return list_of_rows, id_list
 
-def populate_sales_table(records: list, cursor, db_connection, db_name: str):
+def zipf_probabilities(cardinality: int, skew: float) -> np.ndarray:
     """
-    Receives a list of tupples that contain each row data for the "sales" table.
-    Each tupple element should match the data type deffined on the table schema
+    Probabilities of a bounded Zipf distribution over cardinality values, the k-th value has a weight of 1/k**skew.
+    A skew of 0 gives a uniform distribution.
     """
-    try:
-        full_query = f'INSERT INTO {db_name}.sales (product_id, country, category, price, quantity, final_sales) VALUES'
-        for row in records:
-            values = f'({row[0]}, "{row[1]}", "{row[2]}", {row[3]}, {row[4]}, {row[5]}),'
-            if type(row[1]) != str or type(row[2]) != str:
-                return print(f'You are trying to use a number on a string field. row: {row}')
-            else:
-                full_query = f'{full_query} {values}'
-        cursor.execute(full_query[:len(full_query)-1])
-        print(f'Populating sales table')
-        db_connection.commit()
-    except conn.errors.ProgrammingError as error:
-        if "1064" in str(error):
-            return print(f'You are trying to fill a field with an empty value. Fields do not accept NULL values.')
-        elif "1054" in str(error):
-            return print(f'You are trying to fill a field with incorrect data type.')
-        else:
-            return print(f'An exception has ocurred: {error}')
-    except IndexError:
-        return print(f'The row you are trying to populate is missing a value. It should have 6 values on it.')
+    weights = 1.0 / np.arange(1, cardinality + 1) ** skew
+    return weights / weights.sum()
 
-def top_sell_country_category(db_connection, cursor, db_name: str):
+def generate_sales_chunks(total_rows: int, chunk_size: int = 100000, product_count: int = 10,
+                          countries: list = None, categories: list = None, product_skew: float = 0.0,
+                          country_skew: float = 0.0, seed: int = None):
     """
-    Determines the top-selling product categories in each country.
+    NumPy backed version of generate_sales_data for load testing. Generates total_rows random sales rows
+    chunk_size rows at a time and yields them one by one, so it can be passed straight to populate_sales_table
+    without holding the full data set in memory.
+    Product ids go from 1 to product_count. Products and countries can follow a skewed (Zipf) distribution.
     """
-    try:
-        query = f'CREATE TABLE {db_name}.top_sell_country_category AS (\
-                    SELECT product_id, country, category, total\
-                        FROM (\
-                            SELECT product_id, country, category, sum(final_sales) AS total,\
-                                ROW_NUMBER() OVER (PARTITION BY country ORDER BY SUM(final_sales) DESC) AS category_rank\
-                                FROM {db_name}.sales\
-                                GROUP BY country, category) AS rank_table\
-                    WHERE category_rank = 1)'
-        cursor.execute(query)
-        print(f'Creating top_sell_country_category table')
-        db_connection.commit()
-        result = cursor.fetchall()
-        dataframe = pd.DataFrame(result, columns=["Product_id", "Country", "Category", "Total_sales"])
-    except conn.errors.ProgrammingError as error:
-        print(f'An exception has ocurred: {error}')
-        response = input(f'Do you want to remove existing table and create a new one? (yes/no) ')
-        if response.lower() == "yes":
-            drop_query = f'DROP TABLE {db_name}.top_sell_country_category'
-            cursor.execute(drop_query)
-            db_connection.commit()
-            cursor.execute(query)
+    countries = np.array(countries or ["Mexico", "Canada", "US"])
+    categories = np.array(categories or ["phone", "tablet", "laptop"])
+    product_probabilities = zipf_probabilities(product_count, product_skew)
+    country_probabilities = zipf_probabilities(len(countries), country_skew)
+    rng = np.random.default_rng(seed)
+    for start in range(0, total_rows, chunk_size):
+        size = min(chunk_size, total_rows - start)
+        columns = [(rng.choice(product_count, size, p = product_probabilities) + 1).tolist(),
+                   countries[rng.choice(len(countries), size, p = country_probabilities)].tolist(),
+                   categories[rng.integers(0, len(categories), size)].tolist(),
+                   rng.integers(3000, 30001, size).tolist(),
+                   rng.integers(1, 11, size).tolist(),
+                   rng.integers(3000, 100001, size).tolist()]
+        yield from zip(*columns)
+
+def chunk_records(records, chunk_size: int):
+    """
+    Splits any iterable of rows (list, generator, etc.) into lists of at most chunk_size rows.
+    Rows are consumed lazily so the full data set never needs to be held in memory.
+    """
+    iterator = iter(records)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
+
+def flag_last(items):
+    """
+    Yields (item, is_last) pairs, looking one item ahead so the last one can be told apart while streaming
+    """
+    iterator = iter(items)
+    item = next(iterator, None)
+    while item is not None:
+        next_item = next(iterator, None)
+        yield item, next_item is None
+        item = next_item
+
+def db_error_message(error, row_length: int) -> str:
+    """
+    Translates the MySQL error codes raised while inserting rows into a readable message
+    """
+    if "1064" in str(error):
+        return f'You are trying to fill a field with an empty value. Fields do not accept NULL values.'
+    elif "1054" in str(error) or "1366" in str(error):
+        return f'You are trying to fill a field with incorrect data type. Error: {error}'
+    elif "1136" in str(error):
+        return f'The row you are trying to populate is missing a value. It should have {row_length} values on it.'
+    else:
+        return f'An exception has ocurred: {error}'
+
+def invalid_row(chunk: list, row_length: int, string_fields: tuple):
+    """
+    Returns the first row of the chunk that does not match the table layout, None if every row is valid
+    """
+    for row in chunk:
+        if len(row) != row_length:
+            return row
+        for index in string_fields:
+            if not isinstance(row[index], str):
+                return row
+    return None
+
+def write_infile(chunk: list) -> str:
+    """
+    Streams a chunk of rows into a temporary CSV file to be consumed by LOAD DATA LOCAL INFILE.
+    Returns the path of the generated file, which should be removed by the caller.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix = ".csv", newline = "", delete = False) as infile:
+        writer = csv.writer(infile, quoting = csv.QUOTE_MINIMAL, lineterminator = "\n")
+        writer.writerows(chunk)
+    return infile.name
+
+def bulk_load(records, cursor, db_connection, db_name: str, table: str, columns: tuple,
+              string_fields: tuple = (), chunk_size: int = 5000, use_infile: bool = False, upsert_keys: tuple = None,
+              final_query: str = None) -> dict:
+    """
+    Shared bulk loader for every table on the Data Base.
+    Receives any iterable of tupples (each one matching the given columns) and inserts them in chunks of chunk_size rows.
+    Each chunk is sent as a parameterized executemany (or as a LOAD DATA LOCAL INFILE when use_infile is True)
+    and committed on its own, so a bad chunk is reported and rolled back without aborting the whole load.
+    When upsert_keys (the table key columns) is given, rows whose key already exists are updated instead of failing,
+    making the load idempotent.
+    final_query (like a watermark update) is executed in the transaction of the last chunk, only when no chunk failed,
+    so it is committed or rolled back together with the end of the data.
+    Works on MySQL and SQLite connections, LOAD DATA LOCAL INFILE is only available on MySQL.
+    Returns a dict with the loaded rows count and the list of failed chunks with their error message.
+    """
+    backend = db_backend(db_connection)
+    column_names = ", ".join(columns)
+    if use_infile and backend["name"] != "mysql":
+        raise ValueError(f'LOAD DATA LOCAL INFILE is not supported on {backend["name"]}')
+    if use_infile:
+        replace = "REPLACE" if upsert_keys else ""
+        query = f"LOAD DATA LOCAL INFILE %s {replace} INTO TABLE {db_name}.{table} \
+            FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' \
+            LINES TERMINATED BY '\\n' ({column_names})"
+    else:
+        placeholders = ", ".join([backend["placeholder"]] * len(columns))
+        query = f'INSERT INTO {db_name}.{table} ({column_names}) VALUES ({placeholders})'
+        if upsert_keys:
+            updates = [f'{column} = {new_value(backend, column)}' for column in columns if column not in upsert_keys]
+            query = f'{query} {upsert_clause(backend, upsert_keys, updates)}'
+    report = {"loaded_rows": 0, "failed_chunks": []}
+    for chunk_number, (chunk, last_chunk) in enumerate(flag_last(chunk_records(records, chunk_size))):
+        bad_row = invalid_row(chunk, len(columns), string_fields)
+        if bad_row is not None:
+            message = f'Row does not match {table} layout ({len(columns)} values, text on string fields). row: {bad_row}'
+            report["failed_chunks"].append((chunk_number, message))
+            print(f'Chunk {chunk_number} skipped. {message}')
+            continue
+        try:
+            if use_infile:
+                infile_path = write_infile(chunk)
+                try:
+                    cursor.execute(query, (infile_path,))
+                finally:
+                    os.remove(infile_path)
+            else:
+                cursor.executemany(query, chunk)
+            if final_query is not None and last_chunk and not report["failed_chunks"]:
+                cursor.execute(final_query)
             db_connection.commit()
-            cursor.execute(f'SELECT * FROM {db_name}.top_sell_country_category')
-            result = cursor.fetchall()
-            dataframe = pd.DataFrame(result, columns=["Product_id", "Country", "Category", "Total_sales"])
-            print("New table top_sell_country_category has been created")
-            print(dataframe)
-            return None
-        else:
-            return print("Keep exisitng top_sell_country_category table")
+            report["loaded_rows"] += len(chunk)
+            print(f'Populating {table} table: {report["loaded_rows"]} rows loaded')
+        except backend["errors"] as error:
+            db_connection.rollback()
+            message = db_error_message(error, len(columns))
+            report["failed_chunks"].append((chunk_number, message))
+            print(f'Chunk {chunk_number} failed. {message}')
+    if report["loaded_rows"]:
+        invalidate_query_cache(db_connection, cursor, db_name)
+    return report
+
+def populate_sales_table(records, cursor, db_connection, db_name: str, chunk_size: int = 5000, use_infile: bool = False):
+    """
+    Receives an iterable of tupples that contain each row data for the "sales" table.
+    Each tupple element should match the data type deffined on the table schema
+    The summary tables are refreshed with the loaded rows, so aggregate queries are never behind the sales table
+    """
+    columns = ("product_id", "country", "category", "price", "quantity", "final_sales")
+    report = bulk_load(records, cursor, db_connection, db_name, "sales", columns,
+                       string_fields = (1, 2), chunk_size = chunk_size, use_infile = use_infile)
+    if report["loaded_rows"]:
+        refresh_sales_summaries(db_connection, cursor, db_name)
+    return report
 
 def create_product_table(db_connection, cursor, db_name: str):
     """
@@ -166,12 +572,12 @@ def create_product_table(db_connection, cursor, db_name: str):
             memory int NOT NULL,\
             other_specs varchar(128) NOT NULL,\
             PRIMARY KEY (id)\
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin'
+        ) {db_backend(db_connection)["table_options"]}'
         
         cursor.execute(query)
         print(f'Creating product table')
         db_connection.commit()
-    except conn.errors.ProgrammingError as error:
+    except table_exists_errors as error:
         print(f'An exception has ocurred: {error}')
         response = input(f'Do you want to remove existing table and create a new one? (yes/no) ')
         if response.lower() == "yes":
@@ -196,77 +602,205 @@ def generate_product_data(sales_ids: list) -> list:
     color = ["white", "black", "red", "blue", "pink"]
     size = [5, 6, 7, 8, 9, 10, 12, 15, 17]
     specs = ["fast_charge", "usb_c", "5G"]
-    list_of_rows = [(ids.pop(0), random.choice(category),
+    list_of_rows = [(product_id, random.choice(category),
                      random.choice(capacity), random.choice(color),
                      random.choice(size), random.choice(capacity),
-                     random.choice(specs)) for item in range(0, 10)]
+                     random.choice(specs)) for product_id in ids[:10]]
     return list_of_rows
 
-def populate_product_table(records: list, cursor, db_connection, db_name: str):
+def generate_product_chunks(product_count: int, chunk_size: int = 100000, seed: int = None):
+    """
+    NumPy backed version of generate_product_data for load testing. Generates one random product row for
+    each id from 1 to product_count (matching generate_sales_chunks ids) chunk_size rows at a time and yields them one by one.
+    """
+    category = np.array(["phone", "tablet", "laptop"])
+    capacity = np.array([1, 2, 4, 8, 16, 32, 64, 128, 256, 512])
+    color = np.array(["white", "black", "red", "blue", "pink"])
+    size = np.array([5, 6, 7, 8, 9, 10, 12, 15, 17])
+    specs = np.array(["fast_charge", "usb_c", "5G"])
+    rng = np.random.default_rng(seed)
+    for start in range(1, product_count + 1, chunk_size):
+        ids = np.arange(start, min(start + chunk_size, product_count + 1))
+        columns = [ids.tolist()] + [values[rng.integers(0, len(values), len(ids))].tolist()
+                                    for values in [category, capacity, color, size, capacity, specs]]
+        yield from zip(*columns)
+
+def populate_product_table(records, cursor, db_connection, db_name: str, chunk_size: int = 5000, use_infile: bool = False):
     """
-    Receives a list of tupples that contain each row data for the "product" table.
+    Receives an iterable of tupples that contain each row data for the "product" table.
     Each tupple element should match the data type deffined on the table schema
     """
+    columns = ("id", "category", "capacity", "color", "screen_size", "memory", "other_specs")
+    return bulk_load(records, cursor, db_connection, db_name, "product", columns,
+                     string_fields = (1, 3, 6), chunk_size = chunk_size, use_infile = use_infile)
+
+# running aggregate tables of the "sales" table, see create_summary_tables
+summary_tables = ["sales_by_country_category", "sales_by_country_category_product", "sales_by_product", "summary_watermark"]
+
+def create_summary_tables(db_connection, cursor, db_name: str):
+    """
+    Creates (replacing any previous one) the running aggregate tables of the "sales" table:
+    sales_by_country_category (total sales per country and category), sales_by_country_category_product (total sales
+    per country, category and product), sales_by_product (quantity and sales per product) and summary_watermark
+    which keeps the last sale_id already added to each summary (and loaded into transformed_sales).
+    The top_sell_country_category view is kept over them.
+    This is DDL (an implicit commit and a metadata lock on MySQL), so it only runs when the sales table is created
+    or the summaries are missing (see reset_sales_summaries and ensure_summary_tables), never on a refresh.
+    """
+    backend = db_backend(db_connection)
+    table_options = backend["table_options"]
+    queries = [f'CREATE TABLE {db_name}.sales_by_country_category (\
+                    country varchar(256) NOT NULL,\
+                    category varchar(128) NOT NULL,\
+                    total_sales double NOT NULL,\
+                    PRIMARY KEY (country, category)\
+                ) {table_options}',
+               f'CREATE TABLE {db_name}.sales_by_country_category_product (\
+                    country varchar(256) NOT NULL,\
+                    category varchar(128) NOT NULL,\
+                    product_id int NOT NULL,\
+                    total_sales double NOT NULL,\
+                    PRIMARY KEY (country, category, product_id)\
+                ) {table_options}',
+               f'CREATE TABLE {db_name}.sales_by_product (\
+                    product_id int NOT NULL,\
+                    total_quantity bigint NOT NULL,\
+                    total_sales double NOT NULL,\
+                    PRIMARY KEY (product_id)\
+                ) {table_options}',
+               f'CREATE TABLE {db_name}.summary_watermark (\
+                    summary varchar(128) NOT NULL,\
+                    last_sale_id int NOT NULL,\
+                    PRIMARY KEY (summary)\
+                ) {table_options}']
+    queries = [f'DROP TABLE IF EXISTS {db_name}.{table}' for table in summary_tables] + queries
+    if backend["name"] == "sqlite":
+        queries.append(f'DROP VIEW IF EXISTS {db_name}.top_sell_country_category')
+        queries.append(f'CREATE VIEW {db_name}.top_sell_country_category AS {top_sell_query(db_name)}')
+    else:
+        queries.append(f'DROP TABLE IF EXISTS {db_name}.top_sell_country_category')
+        queries.append(f'CREATE OR REPLACE VIEW {db_name}.top_sell_country_category AS {top_sell_query(db_name)}')
+    for query in queries:
+        cursor.execute(query)
+    db_connection.commit()
+
+def reset_sales_summaries(db_connection, cursor, db_name: str):
+    """
+    Recreates the aggregate tables empty, which removes every watermark. Used when the "sales" table is created, dropped or recreated
+    """
+    create_summary_tables(db_connection, cursor, db_name)
+    invalidate_query_cache(db_connection, cursor, db_name)
+
+def ensure_summary_tables(db_connection, cursor, db_name: str):
+    """
+    Creates the summary tables when they are missing (or come from an older layout), probing them with a plain SELECT
+    so refreshes of existing summaries run no DDL at all
+    """
     try:
-        full_query = f'INSERT INTO {db_name}.product (id, category, capacity, color, screen_size, memory, other_specs) VALUES'
-        for row in records:
-            values = f'({row[0]}, "{row[1]}", {row[2]}, "{row[3]}", {row[4]}, {row[5]}, "{row[6]}"),'
-            if type(row[1]) != str or type(row[3]) != str or type(row[6]) != str:
-                return print(f'You are trying to use a number on a string field. row: {row}')
-            else:
-                full_query = f'{full_query} {values}'
-        cursor.execute(full_query[:len(full_query)-1])
-        print(f'Populating product table')
-        db_connection.commit()
-    except conn.errors.ProgrammingError as error:
-        if "1064" in str(error):
-            return print(f'You are trying to fill a field with an empty value. Fields do not accept NULL values.')
-        elif "1054" in str(error):
-            print(error)
-            return print(f'You are trying to fill a field with incorrect data type.')
-        else:
-            return print(f'An exception has ocurred: {error}')
-    except IndexError:
-        return print(f'The row you are trying to populate is missing a value. It should have 7 values on it.')
+        tables = ", ".join(f'{db_name}.{table}' for table in summary_tables + ["top_sell_country_category"])
+        cursor.execute(f'SELECT 1 FROM {tables} WHERE 1 = 0')
+        cursor.fetchall()
+    except db_backend(db_connection)["errors"]:
+        reset_sales_summaries(db_connection, cursor, db_name)
+
+def read_watermark(cursor, db_name: str, summary: str) -> int:
+    """
+    Returns the last sale_id already processed by the given summary (stored on summary_watermark), 0 if nothing has been processed yet
+    """
+    cursor.execute(f"SELECT last_sale_id FROM {db_name}.summary_watermark WHERE summary = '{summary}'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def watermark_query(backend: dict, db_name: str, summary: str, sale_id: int) -> str:
+    """
+    Query that stores sale_id as the last sale_id processed by the given summary on summary_watermark
+    """
+    watermark_upsert = upsert_clause(backend, ("summary",), [f'last_sale_id = {new_value(backend, "last_sale_id")}'])
+    query = f"INSERT INTO {db_name}.summary_watermark (summary, last_sale_id) VALUES ('{summary}', {int(sale_id)})\
+                {watermark_upsert}"
+    return query
+
+def refresh_sales_summaries(db_connection, cursor, db_name: str, full_refresh: bool = False) -> int:
+    """
+    Adds the sales inserted since the last refresh to the running aggregate tables, so the cost depends on the new rows only.
+    The deltas and the new watermark are committed in one transaction. When full_refresh is True, or the max sale_id
+    is behind the watermark, aggregates are rebuilt from scratch (create_sales_table already resets them on a new table).
+    Returns the number of sales added to the aggregates.
+    """
+    backend = db_backend(db_connection)
+    ensure_summary_tables(db_connection, cursor, db_name)
+    last_sale_id = read_watermark(cursor, db_name, "sales")
+    cursor.execute(f'SELECT MAX(sale_id) FROM {db_name}.sales')
+    high_sale_id = cursor.fetchone()[0] or 0
+    if full_refresh or high_sale_id < last_sale_id:
+        for table in [table for table in summary_tables if table != "summary_watermark"]:
+            cursor.execute(f'DELETE FROM {db_name}.{table}')
+        last_sale_id = 0
+    new_sales = f'FROM {db_name}.sales WHERE sale_id > {last_sale_id} AND sale_id <= {high_sale_id}'
+    cursor.execute(f'SELECT COUNT(*) {new_sales}')
+    new_rows = cursor.fetchone()[0]
+    total_upsert = [f'total_sales = total_sales + {new_value(backend, "total_sales")}']
+    category_upsert = upsert_clause(backend, ("country", "category"), total_upsert)
+    category_product_upsert = upsert_clause(backend, ("country", "category", "product_id"), total_upsert)
+    product_upsert = upsert_clause(backend, ("product_id",),
+                                   [f'total_quantity = total_quantity + {new_value(backend, "total_quantity")}',
+                                    f'total_sales = total_sales + {new_value(backend, "total_sales")}'])
+    cursor.execute(f'INSERT INTO {db_name}.sales_by_country_category (country, category, total_sales)\
+                        SELECT country, category, SUM(final_sales) {new_sales}\
+                        GROUP BY country, category\
+                    {category_upsert}')
+    cursor.execute(f'INSERT INTO {db_name}.sales_by_country_category_product (country, category, product_id, total_sales)\
+                        SELECT country, category, product_id, SUM(final_sales) {new_sales}\
+                        GROUP BY country, category, product_id\
+                    {category_product_upsert}')
+    cursor.execute(f'INSERT INTO {db_name}.sales_by_product (product_id, total_quantity, total_sales)\
+                        SELECT product_id, SUM(quantity), SUM(final_sales) {new_sales}\
+                        GROUP BY product_id\
+                    {product_upsert}')
+    cursor.execute(watermark_query(backend, db_name, "sales", high_sale_id))
+    db_connection.commit()
+    if new_rows or last_sale_id == 0:
+        invalidate_query_cache(db_connection, cursor, db_name)
+    print(f'Sales summaries refreshed with {new_rows} new sales')
+    return new_rows
+
+def top_sell_query(db_name: str) -> str:
+    """
+    Query that ranks the categories of each country by total sales and keeps the top one, along with the best selling
+    product of that category in the country (ties are broken by category and product_id, so results do not depend on load order).
+    It reads the summary tables, so its cost does not grow with the sales table.
+    """
+    query = f'SELECT product_rank_table.product_id, category_rank_table.country, category_rank_table.category,\
+                    category_rank_table.total_sales AS total\
+                FROM (\
+                    SELECT country, category, total_sales,\
+                        ROW_NUMBER() OVER (PARTITION BY country ORDER BY total_sales DESC, category) AS category_rank\
+                        FROM {db_name}.sales_by_country_category) AS category_rank_table\
+                JOIN (\
+                    SELECT country, category, product_id,\
+                        ROW_NUMBER() OVER (PARTITION BY country, category ORDER BY total_sales DESC, product_id) AS product_rank\
+                        FROM {db_name}.sales_by_country_category_product) AS product_rank_table\
+                    ON product_rank_table.country = category_rank_table.country\
+                    AND product_rank_table.category = category_rank_table.category\
+                    AND product_rank_table.product_rank = 1\
+                WHERE category_rank_table.category_rank = 1'
+    return query
 
 def top_sell_country_category(db_connection, cursor, db_name: str):
     """
     Determines the top-selling product categories in each country.
+    Running aggregates are refreshed with any sale not added yet and top_sell_country_category is kept as a view over them,
+    so it is always up to date without rebuilding a table from the whole sales table.
     """
-    try:
-        query = f'CREATE TABLE testing.top_sell_country_category AS (\
-                    SELECT product_id, country, category, total\
-                        FROM (\
-                            SELECT product_id, country, category, sum(final_sales) AS total,\
-                                ROW_NUMBER() OVER (PARTITION BY country ORDER BY SUM(final_sales) DESC) AS category_rank\
-                                FROM {db_name}.sales\
-                                GROUP BY country, category) AS rank_table\
-                    WHERE category_rank = 1)'
-        cursor.execute(query)
-        print(f'Creating top_sell_country_category table')
-        db_connection.commit()
-        result = cursor.fetchall()
-        dataframe = pd.DataFrame(result, columns=["Product_id", "Country", "Category", "Total_sales"])
-    except conn.errors.ProgrammingError as error:
-        print(f'An exception has ocurred: {error}')
-        response = input(f'Do you want to remove existing table and create a new one? (yes/no) ')
-        if response.lower() == "yes":
-            drop_query = f'DROP TABLE {db_name}.top_sell_country_category'
-            cursor.execute(drop_query)
-            db_connection.commit()
-            cursor.execute(query)
-            db_connection.commit()
-            result = cursor.fetchall()
-            dataframe = pd.DataFrame(result, columns=["Product_id", "Country", "Category", "Total_sales"])
-            print("New table top_sell_country_category has been created")
-            return dataframe
-        else:
-            return print("Keep exisitng top_sell_country_category table")
+    refresh_sales_summaries(db_connection, cursor, db_name)
+    cursor.execute(f'SELECT * FROM {db_name}.top_sell_country_category')
+    result = cursor.fetchall()
+    dataframe = pd.DataFrame(result, columns=["Product_id", "Country", "Category", "Total_sales"])
     return dataframe
 
-def top_product_specs(cursor, db_name: str):
+def top_product_specs_query(db_name: str) -> str:
     """
-    Retrieves detailed product specifications for these top-selling products
+    Query that joins the top-selling products with their specifications and sales
     """
     query = f'SELECT p.*, tscc.country, s.final_sales\
                 FROM {db_name}.product p\
@@ -274,44 +808,65 @@ def top_product_specs(cursor, db_name: str):
                     {db_name}.top_sell_country_category tscc ON tscc.product_id = p.id\
                 JOIN \
                     {db_name}.sales s ON tscc.product_id = s.product_id '
-    cursor.execute(query)
+    return query
+
+@cached_query
+def top_product_specs(cursor, db_name: str):
+    """
+    Retrieves detailed product specifications for these top-selling products
+    """
+    cursor.execute(top_product_specs_query(db_name))
     result = cursor.fetchall()
     dataframe = pd.DataFrame(result, columns=["id", "Category", "Capacity", "Color", "Screen_size", "Memory", "Other_specs", "Country", "Final_sales"])
     return dataframe
 
+def distinct_products_query(db_name: str) -> str:
+    """
+    Query that retrieves the quantity sold of each product from the sales_by_product aggregate
+    """
+    query = f'SELECT product_id, total_quantity\
+                FROM {db_name}.sales_by_product\
+                ORDER BY product_id'
+    return query
+
+@cached_query
 def total_distinct_products_sold(cursor, db_name: str):
     """
     Determines the total number of distinct products sold
+    Reads the sales_by_product aggregate, refreshed by create_sales_table and populate_sales_table
     """
-    query = f' SELECT \
-	                DISTINCT product_id,\
-                    sum(quantity) \
-                    FROM {db_name}.sales\
-	                GROUP BY product_id'
-    cursor.execute(query)
+    cursor.execute(distinct_products_query(db_name))
     result = cursor.fetchall()
     dataframe = pd.DataFrame(result, columns=["Product_id", "Total_sold"])
     return dataframe
 
+def max_sales_category_query(db_name: str) -> str:
+    """
+    Query that sums the final sales of each category from the sales_by_country_category aggregate
+    """
+    query = f'SELECT category, SUM(total_sales)\
+                FROM {db_name}.sales_by_country_category\
+                GROUP BY category'
+    return query
+
+@cached_query
 def max_sales_category(cursor, db_name: str):
     """
     A query that determines the maximum sales recorded for each category
+    Reads the sales_by_country_category aggregate, refreshed by create_sales_table and populate_sales_table
     """
-    query = f' SELECT \
-	                DISTINCT category,\
-                    sum(final_sales) \
-                    FROM {db_name}.sales\
-	                GROUP BY category'
-    cursor.execute(query)
+    cursor.execute(max_sales_category_query(db_name))
     result = cursor.fetchall()
     dataframe = pd.DataFrame(result, columns=["Category", "Total_sales"])
     return dataframe
 
-def extract_data_from_db(cursor, db_name: str):
+def extract_query(db_name: str, sale_id_range: tuple = None) -> str:
     """
-    Retrieve data from the existing sales and product tables. Including id, country, category, product capacity, color, quantity sold, and final sales amount
+    Query that joins sales and product tables to retrieve the data to be transformed
+    sale_id_range is an optional (low, high) tupple to retrieve just the sales with low < sale_id <= high
     """
     query = f'SELECT\
+                s.sale_id,\
                 s.product_id,\
                 s.country,\
                 p.category,\
@@ -321,36 +876,107 @@ def extract_data_from_db(cursor, db_name: str):
                 s.final_sales\
                 FROM {db_name}.sales s\
                 JOIN {db_name}.product p ON s.product_id = p.id'
-    cursor.execute(query)
+    if sale_id_range is not None:
+        query = f'{query} WHERE s.sale_id > {int(sale_id_range[0])} AND s.sale_id <= {int(sale_id_range[1])}'
+    return query
+
+extract_columns = ["sale_id", "id", "country", "category", "capacity", "color", "quantity", "final_sales"]
+
+def extract_data_from_db(cursor, db_name: str, sale_id_range: tuple = None):
+    """
+    Retrieve data from the existing sales and product tables. Including id, country, category, product capacity, color, quantity sold, and final sales amount
+    """
+    cursor.execute(extract_query(db_name, sale_id_range))
     result = cursor.fetchall()
-    dataframe = pd.DataFrame(result, columns = ["id", "country", "category", "capacity", "color", "quantity", "final_sales"])
+    dataframe = pd.DataFrame(result, columns = extract_columns)
     return dataframe
+
+def stream_data_from_db(db_connection, db_name: str, chunk_size: int = 50000, sale_id_range: tuple = None):
+    """
+    Streaming version of extract_data_from_db. Uses an unbuffered cursor so MySQL sends rows as they are fetched
+    and yields DataFrames of at most chunk_size rows, keeping memory constant no matter the size of the sales table.
+    The connection is busy until the generator is exhausted, so loading the chunks has to be done through another connection
+    (except on SQLite, where the same connection can be used to read and write).
+    """
+    if db_backend(db_connection)["name"] == "sqlite":
+        cursor = db_connection.cursor()
+    else:
+        cursor = db_connection.cursor(buffered = False)
+    try:
+        cursor.execute(extract_query(db_name, sale_id_range))
+        rows = cursor.fetchmany(chunk_size)
+        while rows:
+            yield pd.DataFrame(rows, columns = extract_columns)
+            rows = cursor.fetchmany(chunk_size)
+    finally:
+        cursor.close()
     
-def transform_data(extracted):
+def analytical_queries(db_name: str) -> dict:
+    """
+    Returns every analytical query of the ETL with its name as key
+    """
+    return {"top_sell_country_category": top_sell_query(db_name),
+            "top_product_specs": top_product_specs_query(db_name),
+            "total_distinct_products_sold": distinct_products_query(db_name),
+            "max_sales_category": max_sales_category_query(db_name),
+            "extract_data_from_db": extract_query(db_name)}
+
+def capture_query_plans(cursor, db_name: str, plan_file: str = "query_plans.jsonl"):
+    """
+    Runs EXPLAIN over every analytical query and appends the plans (with a timestamp) as JSON lines to plan_file,
+    so plans of different runs can be compared to spot regressions like full scans or lost indexes.
+    Returns a dataframe with the plan rows of every query.
+    """
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    plans = []
+    for name, query in analytical_queries(db_name).items():
+        cursor.execute(f'{db_backend(cursor)["explain"]} {query}')
+        columns = [column[0] for column in cursor.description]
+        for row in cursor.fetchall():
+            plan_row = {"captured_at": timestamp, "db_name": db_name, "query": name}
+            plan_row.update(zip(columns, row))
+            plans.append(plan_row)
+    with open(plan_file, "a") as file:
+        for plan_row in plans:
+            file.write(json.dumps(plan_row, default = str) + "\n")
+    return pd.DataFrame(plans)
+
+def revenue_range_from_db(cursor, db_name: str) -> tuple:
+    """
+    Pre-aggregates the minimum and maximum total revenue (quantity * final_sales) over the whole extraction,
+    so chunked transformations can categorize every chunk against the same global thresholds
+    """
+    query = f'SELECT\
+                MIN(s.quantity * s.final_sales),\
+                MAX(s.quantity * s.final_sales)\
+                FROM {db_name}.sales s\
+                JOIN {db_name}.product p ON s.product_id = p.id'
+    cursor.execute(query)
+    min_revenue, max_revenue = cursor.fetchone()
+    return min_revenue, max_revenue
+
+def transform_data(extracted, revenue_range: tuple = None):
     """
     This function Implement transformations to calculate the total revenue for each product (defined as quantity * final_sales).
     Categorize each transaction based on sales volume into 'High', 'Medium', or 'Low'.
+    revenue_range is an optional (min, max) total revenue tupple used to set the category scale, when the received
+    dataframe is just a chunk of the extraction it should hold the global values (see revenue_range_from_db)
     Returns two objecst. A list of rows in order to populate the DB table and a Dataframe for visualization
     """
     dataframe = extracted
     dataframe["total_revenue"] = dataframe["quantity"] * dataframe["final_sales"]
     # Determine some values to set a category scale
-    max_revenue = max(dataframe["total_revenue"])
-    min_revenue = min(dataframe["total_revenue"])
+    if revenue_range is None:
+        revenue_range = (dataframe["total_revenue"].min(), dataframe["total_revenue"].max())
+    min_revenue, max_revenue = revenue_range
     revenue_distance = max_revenue - min_revenue
     half_revenue = revenue_distance/2
     upper_limit = half_revenue*1.25
     lower_limit = half_revenue*0.75
-    categories = []
-    for revenue in dataframe["total_revenue"]:
-        if upper_limit < revenue <= max_revenue:
-            categories.append("High")
-        elif upper_limit >= revenue >= lower_limit:
-            categories.append("Medium")
-        elif lower_limit > revenue >= min_revenue:
-            categories.append("Low")
-    dataframe["transact_category"] = categories
-    list_of_rows = list(zip(*map(dataframe.get, dataframe)))
+    revenue = dataframe["total_revenue"].to_numpy()
+    dataframe["transact_category"] = np.select([revenue > upper_limit, revenue >= lower_limit],
+                                               ["High", "Medium"], default = "Low")
+    list_of_rows = list(dataframe.itertuples(index = False, name = None))
     return dataframe, list_of_rows
 
 def create_transformed_sales_table(db_connection, cursor, db_name: str):
@@ -359,6 +985,7 @@ def create_transformed_sales_table(db_connection, cursor, db_name: str):
     """
     try:
         query = f'CREATE TABLE {db_name}.transformed_sales (\
+            sale_id int NOT NULL,\
             id int NOT NULL,\
             country varchar(128) NOT NULL,\
             category varchar(128) NOT NULL,\
@@ -367,13 +994,14 @@ def create_transformed_sales_table(db_connection, cursor, db_name: str):
             quantity int NOT NULL,\
             final_sales double NOT NULL,\
             total_revenue double NOT NULL,\
-            transact_category varchar(128) NOT NULL\
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin'
+            transact_category varchar(128) NOT NULL,\
+            PRIMARY KEY (sale_id)\
+        ) {db_backend(db_connection)["table_options"]}'
         
         cursor.execute(query)
         print(f'Creating transformed_sales table')
         db_connection.commit()
-    except conn.errors.ProgrammingError as error:
+    except table_exists_errors as error:
         print(f'An exception has ocurred: {error}')
         response = input(f'Do you want to remove existing table and create a new one? (yes/no) ')
         if response.lower() == "yes":
@@ -386,88 +1014,142 @@ def create_transformed_sales_table(db_connection, cursor, db_name: str):
         else:
             return print("Keep exisitng transformed_sales table")
    
-def load_data(transformed_data: list, cursor, db_connection, db_name: str):
+def load_data(transformed_data, cursor, db_connection, db_name: str, chunk_size: int = 5000, use_infile: bool = False,
+              final_query: str = None):
     """
-    Receives a list of tupples that contain each row data for the "transformed_sales" table.
+    Receives an iterable of tupples that contain each row data for the "transformed_sales" table.
     Each tupple element should match the data type deffined on the table schema
+    Rows are upserted on sale_id, so loading the same sales twice does not duplicate them.
     """
-    try:
-        full_query = f'INSERT INTO {db_name}.transformed_sales (id, country, category, capacity, color, quantity, final_sales, total_revenue, transact_category) VALUES'
-        for row in transformed_data:
-            values = f'({row[0]}, "{row[1]}", "{row[2]}", {row[3]}, "{row[4]}", {row[5]}, {row[6]}, {row[7]}, "{row[8]}"),'
-            if type(row[1]) != str or type(row[2]) != str or type(row[4]) != str or type(row[8]) != str:
-                return print(f'You are trying to use a number on a string field. row: {row}')
-            else:
-                full_query = f'{full_query} {values}'
-        cursor.execute(full_query[:len(full_query)-1])
-        print(f'Populating product table')
-        db_connection.commit()
-    except conn.errors.ProgrammingError as error:
-        if "1064" in str(error):
-            return print(f'You are trying to fill a field with an empty value. Fields do not accept NULL values.')
-        elif "1054" in str(error):
-            print(error)
-            return print(f'You are trying to fill a field with incorrect data type.')
-        else:
-            return print(f'An exception has ocurred: {error}')
-    except IndexError:
-        return print(f'The row you are trying to populate is missing a value. It should have 9 values on it.')   
-
-host_id = input(f'Provide host: ')
-db_name = input(f'To which DB you want to connect? ')
-user_id= input(f'User: ')
-psw = input(f'Pass: ')
+    columns = ("sale_id", "id", "country", "category", "capacity", "color", "quantity", "final_sales", "total_revenue", "transact_category")
+    return bulk_load(transformed_data, cursor, db_connection, db_name, "transformed_sales", columns,
+                     string_fields = (2, 3, 5, 9), chunk_size = chunk_size, use_infile = use_infile, upsert_keys = ("sale_id",),
+                     final_query = final_query)
 
-connection = db_conn(host_id, user_id, psw)
-if connection is not None:
-    cursor = db_cursor(connection)
+def streaming_etl(read_connection, write_connection, db_name: str, chunk_size: int = 50000, sale_id_range: tuple = None,
+                  revenue_range: tuple = None, final_query: str = None):
+    """
+    Constant-memory version of the extract, transform and load stages.
+    Chunks streamed from read_connection are transformed and loaded through write_connection one at a time,
+    so only chunk_size rows are held in memory at any point. Unless a revenue_range is given, revenue categories use
+    the global min/max revenue of the whole sales table pre-aggregated on the DB (not just of sale_id_range),
+    so results match the non-chunked transformation. final_query is committed with the last chunk (see bulk_load).
+    Returns the bulk_load report.
+    """
+    write_cursor = db_cursor(write_connection)
+    if revenue_range is None:
+        revenue_range = revenue_range_from_db(write_cursor, db_name)
+    transformed_rows = (row for chunk in stream_data_from_db(read_connection, db_name, chunk_size, sale_id_range)
+                        for row in transform_data(chunk, revenue_range)[1])
+    report = load_data(transformed_rows, write_cursor, write_connection, db_name, chunk_size = chunk_size, final_query = final_query)
+    write_cursor.close()
+    return report
 
-    # Creating DB
-    create_database(connection, cursor, db_name)
+def incremental_etl(read_connection, write_connection, db_name: str, chunk_size: int = 50000,
+                    full_refresh: bool = False, revenue_range: tuple = None):
+    """
+    Runs the streaming ETL only over the sales inserted since the last run, using the high-water mark of transformed_sales
+    kept on the summary_watermark table of db_name. With full_refresh transformed_sales is emptied and every sale is processed again (backfills).
+    The high-water mark is committed with the last chunk and only when every chunk was loaded, failed chunks are retried on the next run.
+    Rows already loaded are not categorized again: when revenue_range is None the current min/max revenue of the whole sales table is used,
+    so new rows may be scored against other thresholds than older ones. Pass a fixed revenue_range to keep them stable between runs
+    (or run a full_refresh to categorize every sale again).
+    """
+    backend = db_backend(write_connection)
+    write_cursor = db_cursor(write_connection)
+    ensure_summary_tables(write_connection, write_cursor, db_name)
+    if full_refresh:
+        # the watermark goes with the rows, so a failed backfill is resumed from scratch on the next run
+        write_cursor.execute(f'{backend["truncate"]} {db_name}.transformed_sales')
+        write_cursor.execute(f"DELETE FROM {db_name}.summary_watermark WHERE summary = 'transformed_sales'")
+        write_connection.commit()
+        last_sale_id = 0
+    else:
+        last_sale_id = read_watermark(write_cursor, db_name, "transformed_sales")
+    write_cursor.execute(f'SELECT MAX(sale_id) FROM {db_name}.sales')
+    high_sale_id = write_cursor.fetchone()[0] or 0
+    if high_sale_id <= last_sale_id:
+        write_cursor.close()
+        print(f'No new sales since sale_id {last_sale_id}')
+        return {"loaded_rows": 0, "failed_chunks": []}
+    print(f'Loading sales with sale_id between {last_sale_id} and {high_sale_id}')
+    final_query = watermark_query(backend, db_name, "transformed_sales", high_sale_id)
+    report = streaming_etl(read_connection, write_connection, db_name, chunk_size, (last_sale_id, high_sale_id),
+                           revenue_range, final_query)
+    if not report["loaded_rows"] and not report["failed_chunks"]:
+        # none of the new sales matched a product, there is no chunk to commit the watermark with
+        write_cursor.execute(final_query)
+        write_connection.commit()
+    write_cursor.close()
+    return report
 
-    # Creating and populating sales table
-    create_sales_table(connection, cursor, db_name)
-    sales_data = generate_sales_data()
-    populate_sales_table(sales_data[0], cursor = cursor, db_connection = connection, db_name = db_name)
+def main():
+    """
+    Runs the whole SQL and ETL challenge on a MySQL server
+    """
+    # Credentials are taken from the environment when available
+    host_id = os.environ.get("MYSQL_HOST") or input(f'Provide host: ')
+    db_name = os.environ.get("MYSQL_DB") or input(f'To which DB you want to connect? ')
+    user_id= os.environ.get("MYSQL_USER") or input(f'User: ')
+    psw = os.environ.get("MYSQL_PASSWORD") or input(f'Pass: ')
 
-    # Creating and populating product table
-    create_product_table(connection, cursor, db_name)
-    product_data = generate_product_data(sales_data[1])
-    populate_product_table(product_data, cursor = cursor, db_connection = connection, db_name = db_name)
+    connection = db_conn(host_id, user_id, psw)
+    if connection is not None:
+        cursor = db_cursor(connection)
 
-    # Calculating top-selling product categories in each country
-    print("top-selling product categories in each country")
-    print(top_sell_country_category(connection, cursor, db_name))
+        # Creating DB
+        create_database(connection, cursor, db_name)
 
-    # Retrieve detailed product specifications for these top-selling products
-    print("product specifications for the top-selling products")
-    print(top_product_specs(cursor, db_name))
+        # Creating and populating sales table
+        create_sales_table(connection, cursor, db_name)
+        sales_data = generate_sales_data()
+        populate_sales_table(sales_data[0], cursor = cursor, db_connection = connection, db_name = db_name)
 
-    # Provide additional insights like the total number of distinct products sold
-    print("total number of distinct products sold")
-    print(total_distinct_products_sold(cursor, db_name))
+        # Creating and populating product table
+        create_product_table(connection, cursor, db_name)
+        product_data = generate_product_data(sales_data[1])
+        populate_product_table(product_data, cursor = cursor, db_connection = connection, db_name = db_name)
 
-    # Maximum sales recorded for each category
-    print("maximum sales recorded for each category")
-    print(max_sales_category(cursor, db_name))
+        # Calculating top-selling product categories in each country
+        print("top-selling product categories in each country")
+        print(top_sell_country_category(connection, cursor, db_name))
 
-    # Extracting data from DB
-    extracted_data = extract_data_from_db(cursor, db_name)
+        # Recording the execution plan of the analytical queries
+        capture_query_plans(cursor, db_name)
 
-    # Transofrming data
-    transformed_data = transform_data(extracted_data)
+        # Running the independent read queries concurrently on pooled connections
+        pool = db_pool(host_id, user_id, psw, pool_size = 4)
+        if pool is None:
+            return connection.close()
+        insights = run_concurrent_queries(pool, db_name, [top_product_specs, total_distinct_products_sold,
+                                                          max_sales_category, extract_data_from_db])
 
-    # Creating and populating transformed_sales table
-    create_transformed_sales_table(connection, cursor, db_name)
-    load_data(transformed_data[1], cursor = cursor, db_connection = connection, db_name = db_name)
-    print("Transformed sales data")
-    print(transformed_data[0])
+        # Retrieve detailed product specifications for these top-selling products
+        print("product specifications for the top-selling products")
+        print(insights["top_product_specs"])
 
-    # Closing DB connection
-    connection.close()
+        # Provide additional insights like the total number of distinct products sold
+        print("total number of distinct products sold")
+        print(insights["total_distinct_products_sold"])
 
+        # Maximum sales recorded for each category
+        print("maximum sales recorded for each category")
+        print(insights["max_sales_category"])
 
+        # Extracting data from DB
+        extracted_data = insights["extract_data_from_db"]
 
+        # Transofrming data
+        transformed_data = transform_data(extracted_data)
 
+        # Creating and populating transformed_sales table
+        create_transformed_sales_table(connection, cursor, db_name)
+        load_data(transformed_data[1], cursor = cursor, db_connection = connection, db_name = db_name)
+        print("Transformed sales data")
+        print(transformed_data[0])
 
+        # Closing DB connection
+        connection.close()
 
+if __name__ == "__main__":
+    main()
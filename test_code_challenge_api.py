@@ -1,42 +1,367 @@
+import json
+import hashlib
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 import pytest
-from code_challenge_api import url_request, web_scraping, extracting_json, transforming_data
-
-def test_successful_response():
-    testcase = "https://pokeapi.co/docs/v2#berries-section"
-    assert url_request(testcase).status_code == 200 
-    
-def test_failed_response():
-    testcase = "https://pokeapi.co/api/v2/item/0"
+from code_challenge_api import (url_request, web_scraping, scrape_resources, extract_resources, extracting_json, transforming_data,
+                                http_settings, configure_http_client, configure_response_cache, cache_index,
+                                new_growth_stats, update_growth_stats, growth_stats_frame, configure_stage_log, logged_stage,
+                                latency_histograms, latency_buckets_ms, latency_report, flatten_flavors, load_to_columnar)
+
+# Offline stand-in of pokeapi.co: the docs page keeps the layout of the real one (the berry attributes are the third table)
+# and berries, items and pokemon are generated with the same json layout as the real API.
+# latency (seconds per response), error_rate (share of items answered first with a 503) and the Retry-After
+# header of those answers can be set on each test. /status/<code> always answers with the given status code.
+# Successful answers carry an ETag and are answered with a 304 when it matches the If-None-Match header.
+pokeapi_settings = {
+    "berry_count": 64,
+    "item_count": 30,
+    "pokemon_count": 40,
+    "latency": 0.0,
+    "error_rate": 0.0,
+    "retry_after": "0"}
+default_http_settings = dict(http_settings)
+
+pokeapi_docs = """<html><head><title>Documentation - PokeAPI</title></head><body>
+<h2>Resource Lists/Pagination (group)</h2>
+<p>Calling any API endpoint without a resource ID or name will return a paginated list of available resources for that API.</p>
+<h4>NamedAPIResourceList (type)</h4>
+<table><thead><tr><th>Name</th><th>Description</th><th>Type</th></tr></thead><tbody>
+<tr><td>count</td><td>The total number of resources available from this API.</td><td>integer</td></tr>
+<tr><td>next</td><td>The URL for the next page in the list.</td><td>string</td></tr>
+<tr><td>previous</td><td>The URL for the previous page in the list.</td><td>string</td></tr>
+<tr><td>results</td><td>A list of named API resources.</td><td>list NamedAPIResource</td></tr>
+</tbody></table>
+<h4>APIResourceList (type)</h4>
+<table><thead><tr><th>Name</th><th>Description</th><th>Type</th></tr></thead><tbody>
+<tr><td>count</td><td>The total number of resources available from this API.</td><td>integer</td></tr>
+<tr><td>next</td><td>The URL for the next page in the list.</td><td>string</td></tr>
+<tr><td>previous</td><td>The URL for the previous page in the list.</td><td>string</td></tr>
+<tr><td>results</td><td>A list of unnamed API resources.</td><td>list APIResource</td></tr>
+</tbody></table>
+<h2>Berries (group)</h2>
+<h3>Berries (endpoint)</h3>
+<p>Berries are small fruits that can provide HP and status condition restoration, stat enhancement, and even damage negation when eaten by Pokemon.</p>
+<p>GET BASE_URL/api/v2/berry/{id or name}/</p>
+<h4>Berry (type)</h4>
+<table><thead><tr><th>Name</th><th>Description</th><th>Type</th></tr></thead><tbody>
+<tr><td>id</td><td>The identifier for this resource.</td><td>integer</td></tr>
+<tr><td>name</td><td>The name for this resource.</td><td>string</td></tr>
+<tr><td>growth_time</td><td>Time it takes the tree to grow one stage, in hours.</td><td>integer</td></tr>
+<tr><td>max_harvest</td><td>The maximum number of these berries that can grow on one tree in Generation IV.</td><td>integer</td></tr>
+<tr><td>natural_gift_power</td><td>The power of the move "Natural Gift" when used with this Berry.</td><td>integer</td></tr>
+<tr><td>size</td><td>The size of this Berry, in millimeters.</td><td>integer</td></tr>
+<tr><td>smoothness</td><td>The smoothness of this Berry, used in making Pokeblocks or Poffins.</td><td>integer</td></tr>
+<tr><td>soil_dryness</td><td>The speed at which this Berry dries out the soil as it grows.</td><td>integer</td></tr>
+<tr><td>firmness</td><td>The firmness of this berry, used in making Pokeblocks or Poffins.</td><td>NamedAPIResource (BerryFirmness)</td></tr>
+<tr><td>flavors</td><td>A list of references to each flavor a berry can have and the potency of each of those flavors in regard to this berry.</td><td>list BerryFlavorMap</td></tr>
+<tr><td>item</td><td>Berries are actually items. This is a reference to the item specific data for this berry.</td><td>NamedAPIResource (Item)</td></tr>
+<tr><td>natural_gift_type</td><td>The type inherited by "Natural Gift" when used with this Berry.</td><td>NamedAPIResource (Type)</td></tr>
+</tbody></table>
+<h2>Items (group)</h2>
+<h3>Item (endpoint)</h3>
+<p>An item is an object in the games which the player can pick up, keep in their bag, and use in some manner.</p>
+<p>GET BASE_URL/api/v2/item/{id or name}/</p>
+<h4>Item (type)</h4>
+<table><thead><tr><th>Name</th><th>Description</th><th>Type</th></tr></thead><tbody>
+<tr><td>id</td><td>The identifier for this resource.</td><td>integer</td></tr>
+<tr><td>name</td><td>The name for this resource.</td><td>string</td></tr>
+<tr><td>cost</td><td>The price of this item in stores.</td><td>integer</td></tr>
+<tr><td>fling_power</td><td>The power of the move Fling when used with this item.</td><td>integer</td></tr>
+<tr><td>fling_effect</td><td>The effect of the move Fling when used with this item.</td><td>NamedAPIResource (ItemFlingEffect)</td></tr>
+<tr><td>attributes</td><td>A list of attributes this item has.</td><td>list NamedAPIResource (ItemAttribute)</td></tr>
+<tr><td>category</td><td>The category of items this item falls into.</td><td>NamedAPIResource (ItemCategory)</td></tr>
+</tbody></table>
+<h4>ItemSprites (type)</h4>
+<table><thead><tr><th>Name</th><th>Description</th><th>Type</th></tr></thead><tbody>
+<tr><td>default</td><td>The default depiction of this item.</td><td>string</td></tr>
+</tbody></table>
+<h2>Pokemon (group)</h2>
+<h3>Pokemon (endpoint)</h3>
+<p>Pokemon are the creatures that inhabit the world of the Pokemon games.</p>
+<p>GET BASE_URL/api/v2/pokemon/{id or name}/</p>
+<h4>Pokemon (type)</h4>
+<table><thead><tr><th>Name</th><th>Description</th><th>Type</th></tr></thead><tbody>
+<tr><td>id</td><td>The identifier for this resource.</td><td>integer</td></tr>
+<tr><td>name</td><td>The name for this resource.</td><td>string</td></tr>
+<tr><td>base_experience</td><td>The base experience gained for defeating this Pokemon.</td><td>integer</td></tr>
+<tr><td>height</td><td>The height of this Pokemon in decimetres.</td><td>integer</td></tr>
+<tr><td>is_default</td><td>Set for exactly one Pokemon used as the default for each species.</td><td>boolean</td></tr>
+<tr><td>weight</td><td>The weight of this Pokemon in hectograms.</td><td>integer</td></tr>
+<tr><td>abilities</td><td>A list of abilities this Pokemon could potentially have.</td><td>list PokemonAbility</td></tr>
+<tr><td>species</td><td>The species this Pokemon belongs to.</td><td>NamedAPIResource (PokemonSpecies)</td></tr>
+</tbody></table>
+</body></html>"""
+
+def synthetic_berry(berry_id: int, base_url: str) -> dict:
+    flavors = ["spicy", "dry", "sweet", "bitter", "sour"]
+    return {"id": berry_id,
+            "name": f'berry-{berry_id}',
+            "growth_time": [2, 3, 4, 5, 6, 8, 12, 15, 18, 24][berry_id % 10],
+            "max_harvest": 5 + berry_id % 11,
+            "natural_gift_power": 60 + 10 * (berry_id % 3),
+            "size": 20 + 7 * berry_id % 300,
+            "smoothness": 20 + 5 * (berry_id % 7),
+            "soil_dryness": [4, 6, 7, 8, 10, 15, 35][berry_id % 7],
+            "firmness": {"name": ["very-soft", "soft", "hard", "very-hard", "super-hard"][berry_id % 5],
+                         "url": f'{base_url}/api/v2/berry-firmness/{berry_id % 5 + 1}/'},
+            "flavors": [{"potency": 10 * ((berry_id + position) % 4), "flavor": {"name": flavor, "url": f'{base_url}/api/v2/berry-flavor/{position + 1}/'}}
+                        for position, flavor in enumerate(flavors)],
+            "item": {"name": f'berry-{berry_id}-berry', "url": f'{base_url}/api/v2/item/{125 + berry_id}/'},
+            "natural_gift_type": {"name": ["fire", "water", "electric", "grass", "ice"][berry_id % 5],
+                                  "url": f'{base_url}/api/v2/type/{10 + berry_id % 5}/'}}
+
+def synthetic_item(item_id: int, base_url: str) -> dict:
+    return {"id": item_id,
+            "name": f'item-{item_id}',
+            "cost": 100 * (item_id % 13),
+            "fling_power": None if item_id % 4 == 0 else 10 * (item_id % 9),
+            "fling_effect": None if item_id % 3 else {"name": "badly-poison", "url": f'{base_url}/api/v2/item-fling-effect/1/'},
+            "attributes": [{"name": attribute, "url": f'{base_url}/api/v2/item-attribute/{position + 1}/'}
+                           for position, attribute in enumerate(["countable", "consumable", "holdable"][:item_id % 4])],
+            "category": {"name": ["standard-balls", "healing", "medicine"][item_id % 3], "url": f'{base_url}/api/v2/item-category/{item_id % 3 + 1}/'},
+            "sprites": {"default": f'{base_url}/sprites/items/item-{item_id}.png'}}
+
+def synthetic_pokemon(pokemon_id: int, base_url: str) -> dict:
+    return {"id": pokemon_id,
+            "name": f'pokemon-{pokemon_id}',
+            "base_experience": None if pokemon_id % 10 == 0 else 40 + 3 * pokemon_id,
+            "height": 3 + pokemon_id % 20,
+            "is_default": pokemon_id % 5 != 0,
+            "weight": 20 + 11 * pokemon_id,
+            "abilities": [{"ability": {"name": f'ability-{pokemon_id % 7}', "url": f'{base_url}/api/v2/ability/{pokemon_id % 7}/'},
+                           "is_hidden": False, "slot": 1}],
+            "species": {"name": f'species-{pokemon_id}', "url": f'{base_url}/api/v2/pokemon-species/{pokemon_id}/'}}
+
+synthetic_resources = {"berry": synthetic_berry, "item": synthetic_item, "pokemon": synthetic_pokemon}
+
+class PokeAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    failed_requests = set()
+    hits = {}
+    statuses = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        time.sleep(pokeapi_settings["latency"])
+        base_url = f'http://127.0.0.1:{self.server.server_port}'
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        with self.lock:
+            self.hits[url.path] = self.hits.get(url.path, 0) + 1
+        if len(parts) == 2 and parts[0] == "status":
+            return self.answer(int(parts[1]), "Status", headers = {"Retry-After": pokeapi_settings["retry_after"]})
+        if parts == ["docs", "v2"]:
+            return self.answer(200, pokeapi_docs.replace("BASE_URL", base_url), "text/html")
+        if len(parts) < 3 or parts[:2] != ["api", "v2"] or parts[2] not in synthetic_resources:
+            return self.answer(404, "Not Found")
+        resource = parts[2]
+        count = pokeapi_settings[f'{resource}_count']
+        if len(parts) == 3:
+            query = parse_qs(url.query)
+            limit, offset = int(query.get("limit", [20])[0]), int(query.get("offset", [0])[0])
+            last = min(offset + limit, count)
+            page = {"count": count,
+                    "next": f'{base_url}/api/v2/{resource}/?limit={limit}&offset={last}' if last < count else None,
+                    "previous": None,
+                    "results": [{"name": f'{resource}-{item_id}', "url": f'{base_url}/api/v2/{resource}/{item_id}/'} for item_id in range(offset + 1, last + 1)]}
+            return self.answer(200, json.dumps(page))
+        item_id = int(parts[3]) if parts[3].isdigit() else 0
+        if not 1 <= item_id <= count:
+            return self.answer(404, "Not Found")
+        with self.lock:
+            inject_error = (resource, item_id) not in self.failed_requests and random.Random(item_id).random() < pokeapi_settings["error_rate"]
+            if inject_error:
+                self.failed_requests.add((resource, item_id))
+        if inject_error:
+            return self.answer(503, "Service Unavailable", headers = {"Retry-After": pokeapi_settings["retry_after"]})
+        return self.answer(200, json.dumps(synthetic_resources[resource](item_id, base_url)))
+
+    def answer(self, status_code: int, body: str, content_type: str = "application/json", headers: dict = None):
+        content = body.encode("utf-8")
+        if status_code == 200:
+            etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+            headers = dict(headers or {}, ETag = etag)
+            if self.headers.get("If-None-Match") == etag:
+                status_code, content = 304, b""
+        with self.lock:
+            self.statuses[status_code] = self.statuses.get(status_code, 0) + 1
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        if status_code != 304:
+            self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture(scope = "module")
+def pokeapi_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PokeAPIHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def pokeapi(pokeapi_server):
+    pokeapi_settings.update({"berry_count": 64, "item_count": 30, "pokemon_count": 40, "latency": 0.0, "error_rate": 0.0, "retry_after": "0"})
+    PokeAPIHandler.failed_requests.clear()
+    PokeAPIHandler.hits.clear()
+    PokeAPIHandler.statuses.clear()
+    configure_http_client(**default_http_settings)
+    yield pokeapi_server
+    configure_http_client(**default_http_settings)
+    configure_response_cache(None)
+
+def test_successful_response(pokeapi):
+    testcase = f'{pokeapi}/docs/v2#berries-section'
+    assert url_request(testcase).status_code == 200
+
+def test_failed_response(pokeapi):
+    testcase = f'{pokeapi}/api/v2/item/0'
     assert url_request(testcase).status_code != 200, "Server not Found"
 
-def test_url_berry_template():
-    request = url_request("https://pokeapi.co/docs/v2#berries-section")
-    testcase = "https://pokeapi.co/api/v2/berry/"
+def test_server_errors_are_retried_until_max_retries(pokeapi):
+    configure_http_client(max_retries = 2, backoff = 0.01)
+    testcase = 3
+    assert url_request(f'{pokeapi}/status/503').status_code == 503
+    assert PokeAPIHandler.hits["/status/503"] == testcase
+
+def test_client_errors_are_not_retried(pokeapi):
+    testcase = 1
+    assert url_request(f'{pokeapi}/status/404').status_code == 404
+    assert PokeAPIHandler.hits["/status/404"] == testcase
+
+def test_retry_after_is_capped(pokeapi):
+    pokeapi_settings.update({"error_rate": 1.0, "retry_after": "3600"})
+    configure_http_client(max_retry_after = 0.05)
+    start = time.perf_counter()
+    request = url_request(f'{pokeapi}/api/v2/berry/1/')
+    testcase = 1
+    assert request.status_code == 200
+    assert time.perf_counter() - start < testcase
+
+def test_connection_errors_are_retried(pokeapi):
+    configure_http_client(max_retries = 1, backoff = 0.01, connect_timeout = 1)
+    testcase = None
+    assert url_request("http://127.0.0.1:9/") == testcase
+
+def test_fresh_cached_response_skips_the_network(pokeapi, tmp_path):
+    configure_response_cache(str(tmp_path))
+    first = url_request(f'{pokeapi}/api/v2/berry/1/')
+    second = url_request(f'{pokeapi}/api/v2/berry/1/')
+    testcase = 1
+    assert second.status_code == 200
+    assert second.text == first.text
+    assert PokeAPIHandler.hits["/api/v2/berry/1/"] == testcase
+
+def test_stale_cached_response_is_revalidated(pokeapi, tmp_path):
+    configure_response_cache(str(tmp_path), ttl = 0)
+    first = url_request(f'{pokeapi}/api/v2/berry/1/')
+    second = url_request(f'{pokeapi}/api/v2/berry/1/')
+    testcase = 1
+    assert second.status_code == 200
+    assert second.text == first.text
+    assert PokeAPIHandler.hits["/api/v2/berry/1/"] == 2
+    assert PokeAPIHandler.statuses[304] == testcase
+
+def test_least_recently_used_responses_are_evicted(pokeapi, tmp_path):
+    configure_response_cache(str(tmp_path))
+    url_request(f'{pokeapi}/api/v2/berry/1/')
+    entry_size = os.path.getsize(os.path.join(tmp_path, os.listdir(tmp_path)[0]))
+    configure_response_cache(str(tmp_path), max_bytes = 3 * entry_size + entry_size // 2)
+    for berry_id in [2, 3, 1, 4]:
+        url_request(f'{pokeapi}/api/v2/berry/{berry_id}/')
+    url_request(f'{pokeapi}/api/v2/berry/2/')
+    testcase = 3
+    assert len(os.listdir(tmp_path)) == testcase
+    assert len(cache_index) == testcase
+    assert PokeAPIHandler.hits["/api/v2/berry/1/"] == 1
+    assert PokeAPIHandler.hits["/api/v2/berry/2/"] == 2
+
+def test_offline_mode_uses_only_the_cache(pokeapi, tmp_path):
+    configure_response_cache(str(tmp_path), ttl = 0)
+    first = url_request(f'{pokeapi}/api/v2/berry/1/')
+    configure_response_cache(str(tmp_path), ttl = 0, offline = True)
+    testcase = 1
+    assert url_request(f'{pokeapi}/api/v2/berry/1/').text == first.text
+    assert url_request(f'{pokeapi}/api/v2/berry/2/') is None
+    assert PokeAPIHandler.hits["/api/v2/berry/1/"] == testcase
+    assert "/api/v2/berry/2/" not in PokeAPIHandler.hits
+
+def test_latency_histogram_per_host(pokeapi):
+    latency_histograms.clear()
+    pokeapi_settings["latency"] = 0.03
+    for berry_id in [1, 2, 3]:
+        url_request(f'{pokeapi}/api/v2/berry/{berry_id}/')
+    report = latency_report()
+    testcase = pokeapi.split("//")[1]
+    assert report["host"].unique().tolist() == [testcase]
+    assert report["up_to_ms"].tolist() == latency_buckets_ms
+    assert report["requests"].sum() == 3
+    assert report.loc[report["up_to_ms"] <= 25, "requests"].sum() == 0
+
+def test_url_berry_template(pokeapi):
+    request = url_request(f'{pokeapi}/docs/v2#berries-section')
+    testcase = f'{pokeapi}/api/v2/berry/'
 
     assert web_scraping(request)[0] == testcase
 
-def test_header_names():
-    request = url_request("https://pokeapi.co/docs/v2#berries-section")
+def test_header_names(pokeapi):
+    request = url_request(f'{pokeapi}/docs/v2#berries-section')
     testcase = ["id", "name", "growth_time", "max_harvest", "natural_gift_power", "size", "smoothness", "soil_dryness", "firmness", "flavors", "item", "natural_gift_type"]
     print(web_scraping(request)[1][0])
     for i in range (0, len(testcase)):
         assert web_scraping(request)[1][i][0] == testcase[i]
 
-def test_header_lenght():
-    request = url_request("https://pokeapi.co/docs/v2#berries-section")
+def test_header_lenght(pokeapi):
+    request = url_request(f'{pokeapi}/docs/v2#berries-section')
     testcase = ["id", "name", "growth_time", "max_harvest", "natural_gift_power", "size", "smoothness", "soil_dryness", "firmness", "flavors", "item", "natural_gift_type"]
     assert len(web_scraping(request)[1]) == len(testcase)
 
-def test_json_data_was_extracted():
-    request = url_request("https://pokeapi.co/docs/v2#berries-section")
+def test_json_data_was_extracted(pokeapi):
+    request = url_request(f'{pokeapi}/docs/v2#berries-section')
     url = web_scraping(request)[0]
     headers = web_scraping(request)[1]
-    df = extracting_json(url, headers)  
-    testcase = 64 
+    df = extracting_json(url, headers)
+    testcase = 64
     assert len(df) >= testcase
 
-def test_transformed_data_header_names():
-    request = url_request("https://pokeapi.co/docs/v2#berries-section")
+def test_json_data_survives_server_errors(pokeapi):
+    pokeapi_settings["error_rate"] = 0.25
+    request = url_request(f'{pokeapi}/docs/v2#berries-section')
+    url, headers = web_scraping(request)
+    df = extracting_json(url, headers)
+    testcase = list(range(1, 65))
+    assert len(PokeAPIHandler.failed_requests) > 0
+    assert df["id"].tolist() == testcase
+
+def test_several_resources_are_extracted(pokeapi):
+    pokeapi_settings["error_rate"] = 0.1
+    resources = scrape_resources(url_request(f'{pokeapi}/docs/v2#berries-section'))
+    dataframes = extract_resources({name: resources[name] for name in ["berry", "item", "pokemon"]})
+    testcase = {"berry": 64, "item": 30, "pokemon": 40}
+    assert {name: len(dataframe) for name, dataframe in dataframes.items()} == testcase
+    assert dataframes["berry"]["firmness"].tolist()[:2] == ["soft", "hard"]
+    assert dataframes["item"]["attributes"][2] == ["countable", "consumable", "holdable"]
+    assert dataframes["item"]["fling_effect"].isna().sum() == 20
+    assert str(dataframes["item"]["fling_power"].dtype) == "Int64"
+    assert str(dataframes["pokemon"]["weight"].dtype) == "int64"
+    assert dataframes["pokemon"]["is_default"].dtype == bool
+
+def test_transformed_data_header_names(pokeapi):
+    request = url_request(f'{pokeapi}/docs/v2#berries-section')
     url = web_scraping(request)[0]
     headers = web_scraping(request)[1]
     df = extracting_json(url, headers)
@@ -46,14 +371,93 @@ def test_transformed_data_header_names():
     for i in range(0, len(testcase)):
         assert headers[i] == testcase[i]
 
-def test_statistics_in_dataframe():
-    request = url_request("https://pokeapi.co/docs/v2#berries-section")
+def test_statistics_in_dataframe(pokeapi):
+    request = url_request(f'{pokeapi}/docs/v2#berries-section')
     url = web_scraping(request)[0]
     headers = web_scraping(request)[1]
     df = extracting_json(url, headers)
     transformed_df = transforming_data(df)
     testcase = 1
     assert len(transformed_df) == testcase
-    
+
+@pytest.mark.parametrize("keep_records", [True, False])
+def test_batched_statistics_match_transformed_data(keep_records):
+    import pandas as pd
+    df = pd.DataFrame([synthetic_berry(berry_id, "") for berry_id in range(1, 66)])
+    stats = new_growth_stats(keep_records)
+    for start in range(0, len(df), 20):
+        stats = update_growth_stats(stats, df.iloc[start:start + 20])
+    batched_df = growth_stats_frame(stats)
+    testcase = transforming_data(df)
+    for column in ["min_growth_time", "median_growth_time", "max_growth_time", "variance_growth_time", "mean_growth_time"]:
+        assert batched_df[column][0] == pytest.approx(testcase[column][0])
+    assert batched_df["frequency_growth_time"][0] == testcase["frequency_growth_time"][0]
+    if keep_records:
+        assert batched_df["berries_names"][0] == testcase["berries_names"][0]
+    else:
+        assert batched_df["berries_names"][0] is None
+
+def test_logged_stage_records_layout(tmp_path):
+    log_file = tmp_path / "stage_log.jsonl"
+    configure_stage_log(str(log_file), buffer_size = 2)
+
+    @logged_stage("listing")
+    def listing(size):
+        if size < 0:
+            raise ValueError("negative size")
+        return list(range(size))
+
+    listing(3)
+    with pytest.raises(ValueError):
+        listing(-1)
+    configure_stage_log()
+    records = [json.loads(line) for line in log_file.read_text().splitlines()]
+    testcase = ["stage", "start", "end", "duration_s", "rows", "bytes", "peak_rss_mb", "status"]
+    assert [list(record) for record in records] == [testcase, testcase]
+    assert [(record["stage"], record["rows"], record["status"]) for record in records] == [("listing", 3, "ok"), ("listing", None, "error")]
+    assert records[0]["start"] <= records[0]["end"]
+    assert records[0]["duration_s"] >= 0
+    assert records[0]["bytes"] == 0
+
+def test_flavors_are_flattened(pokeapi):
+    url, headers = web_scraping(url_request(f'{pokeapi}/docs/v2#berries-section'))
+    df = flatten_flavors(extracting_json(url, headers))
+    testcase = [{"flavor": "spicy", "potency": 10}, {"flavor": "dry", "potency": 20}, {"flavor": "sweet", "potency": 30},
+                {"flavor": "bitter", "potency": 0}, {"flavor": "sour", "potency": 10}]
+    assert df["flavors"][0] == testcase
+    assert [df[f'flavor_{flavor["flavor"]}'][0] for flavor in testcase] == [flavor["potency"] for flavor in testcase]
+    assert str(df["flavor_spicy"].dtype) == "int64"
+
+def test_columnar_file_schema(pokeapi, tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+    url, headers = web_scraping(url_request(f'{pokeapi}/docs/v2#berries-section'))
+    df = extracting_json(url, headers)
+    df["ranks"] = [{"first": berry_id, "second": 2 * berry_id} for berry_id in df["id"]]
+    load_to_columnar(df, str(tmp_path / "berries.parquet"))
+    load_to_columnar(df, str(tmp_path / "berries.feather"), file_format = "feather")
+    for schema in [pq.read_schema(tmp_path / "berries.parquet"), feather.read_table(tmp_path / "berries.feather").schema]:
+        for column in ["firmness", "item", "natural_gift_type"]:
+            assert pa.types.is_dictionary(schema.field(column).type)
+        assert schema.field("flavors").type == pa.list_(pa.struct([("flavor", pa.string()), ("potency", pa.int64())]))
+        assert schema.field("ranks").type == pa.list_(pa.struct([("key", pa.string()), ("value", pa.int64())]))
+        testcase = ["flavor_spicy", "flavor_dry", "flavor_sweet", "flavor_bitter", "flavor_sour"]
+        assert [schema.field(column).type for column in testcase] == [pa.int64()] * len(testcase)
+    assert pq.read_table(tmp_path / "berries.parquet").num_rows == 64
+    with pytest.raises(ValueError):
+        load_to_columnar(df, str(tmp_path / "berries.csv"), file_format = "csv")
+
+@pytest.mark.parametrize("berry_count", [64, 256])
+@pytest.mark.parametrize("max_workers", [1, 4, 16])
+def test_extraction_throughput(pokeapi, benchmark, berry_count, max_workers):
+    pokeapi_settings.update({"berry_count": berry_count, "latency": 0.002})
+    url, headers = web_scraping(url_request(f'{pokeapi}/docs/v2#berries-section'))
+    df = benchmark.pedantic(extracting_json, args = (url, headers), kwargs = {"max_workers": max_workers}, rounds = 3, iterations = 1)
+    if benchmark.stats is not None:
+        benchmark.extra_info["berries_per_second"] = round(berry_count / benchmark.stats.stats.mean)
+    testcase = berry_count
+    assert len(df) == testcase
+
 if __name__ == "__main__":
     pytest.main()
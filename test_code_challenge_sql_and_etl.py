@@ -0,0 +1,180 @@
+import json
+import pytest
+from code_challenge_sql_and_etl import (sqlite_conn, db_cursor, create_database, create_sales_table, create_product_table,
+                                        create_transformed_sales_table, generate_sales_chunks, generate_product_chunks,
+                                        populate_sales_table, populate_product_table, top_sell_country_category,
+                                        max_sales_category, total_distinct_products_sold, extract_data_from_db, transform_data, load_data,
+                                        streaming_etl, incremental_etl, read_watermark, configure_query_cache,
+                                        sales_table_query, sqlite_backend, capture_query_plans, refresh_sales_summaries)
+
+@pytest.fixture
+def sales_db():
+    connection = sqlite_conn()
+    cursor = db_cursor(connection)
+    create_database(connection, cursor, "testing")
+    create_sales_table(connection, cursor, "testing")
+    create_product_table(connection, cursor, "testing")
+    create_transformed_sales_table(connection, cursor, "testing")
+    populate_sales_table(generate_sales_chunks(1000, seed = 1), cursor, connection, "testing", chunk_size = 300)
+    populate_product_table(generate_product_chunks(10, seed = 1), cursor, connection, "testing")
+    yield connection, cursor
+    connection.close()
+
+def test_populated_rows(sales_db):
+    connection, cursor = sales_db
+    testcase = 1000
+    cursor.execute("SELECT COUNT(*) FROM testing.sales")
+    assert cursor.fetchone()[0] == testcase
+
+def test_bad_chunk_is_reported(sales_db):
+    connection, cursor = sales_db
+    records = [(1, "Mexico", "phone", 3000, 1, 3000)] * 5 + [(1, 2, "phone", 3000, 1, 3000)]
+    report = populate_sales_table(records, cursor, connection, "testing", chunk_size = 5)
+    assert report["loaded_rows"] == 5
+    assert len(report["failed_chunks"]) == 1
+
+def test_top_sell_country_category_follows_new_sales(sales_db):
+    connection, cursor = sales_db
+    top_sell_country_category(connection, cursor, "testing")
+    populate_sales_table(generate_sales_chunks(500, seed = 2), cursor, connection, "testing")
+    top_sell_df = top_sell_country_category(connection, cursor, "testing")
+    cursor.execute("SELECT country, MAX(total) FROM (SELECT country, category, SUM(final_sales) AS total\
+                        FROM testing.sales GROUP BY country, category) GROUP BY country")
+    testcase = dict(cursor.fetchall())
+    assert dict(zip(top_sell_df["Country"], top_sell_df["Total_sales"])) == pytest.approx(testcase)
+
+def test_top_sell_product_does_not_depend_on_load_history():
+    connection = sqlite_conn()
+    cursor = db_cursor(connection)
+    create_database(connection, cursor, "history")
+    create_sales_table(connection, cursor, "history")
+    populate_sales_table([(5, "US", "phone", 1000, 1, 1000)], cursor, connection, "history")
+    populate_sales_table([(2, "US", "phone", 9000, 1, 900000)], cursor, connection, "history")
+    incremental_df = top_sell_country_category(connection, cursor, "history")
+    refresh_sales_summaries(connection, cursor, "history", full_refresh = True)
+    full_refresh_df = top_sell_country_category(connection, cursor, "history")
+    connection.close()
+    testcase = [(2, "US", "phone", 901000)]
+    assert list(incremental_df.itertuples(index = False, name = None)) == testcase
+    assert list(full_refresh_df.itertuples(index = False, name = None)) == testcase
+
+def test_summary_refresh_runs_no_ddl(sales_db):
+    connection, cursor = sales_db
+    statements = []
+    connection.set_trace_callback(statements.append)
+    populate_sales_table(generate_sales_chunks(100, seed = 2), cursor, connection, "testing")
+    top_sell_country_category(connection, cursor, "testing")
+    incremental_etl(connection, connection, "testing")
+    connection.set_trace_callback(None)
+    testcase = []
+    assert [statement for statement in statements if statement.split()[0].upper() in ("CREATE", "DROP", "ALTER")] == testcase
+
+def test_max_sales_category_is_invalidated_by_new_sales(sales_db):
+    connection, cursor = sales_db
+    before = max_sales_category(cursor, "testing")["Total_sales"].sum()
+    populate_sales_table([(1, "Mexico", "phone", 3000, 1, 3000)], cursor, connection, "testing")
+    after = max_sales_category(cursor, "testing")["Total_sales"].sum()
+    assert after == pytest.approx(before + 3000)
+
+def test_recreated_sales_table_resets_summaries(sales_db, monkeypatch):
+    connection, cursor = sales_db
+    monkeypatch.setattr("builtins.input", lambda prompt: "yes")
+    create_sales_table(connection, cursor, "testing")
+    populate_sales_table(generate_sales_chunks(2000, seed = 3), cursor, connection, "testing")
+    cursor.execute("SELECT SUM(final_sales), SUM(quantity) FROM testing.sales")
+    testcase = cursor.fetchone()
+    assert max_sales_category(cursor, "testing")["Total_sales"].sum() == pytest.approx(testcase[0])
+    assert total_distinct_products_sold(cursor, "testing")["Total_sold"].sum() == testcase[1]
+
+def test_cached_query_follows_writes_of_other_connections(tmp_path):
+    configure_query_cache(disk_dir = str(tmp_path / "cache"))
+    connections = [sqlite_conn(str(tmp_path)), sqlite_conn(str(tmp_path))]
+    cursors = [db_cursor(connection) for connection in connections]
+    for connection, cursor in zip(connections, cursors):
+        create_database(connection, cursor, "shared")
+    create_sales_table(connections[0], cursors[0], "shared")
+    populate_sales_table(generate_sales_chunks(100, seed = 1), cursors[0], connections[0], "shared")
+    before = max_sales_category(cursors[0], "shared")["Total_sales"].sum()
+    # the second connection writes like another process without the disk tier, leaving the cached files in place
+    configure_query_cache()
+    populate_sales_table([(1, "Mexico", "phone", 3000, 1, 3000)], cursors[1], connections[1], "shared")
+    configure_query_cache(disk_dir = str(tmp_path / "cache"))
+    after = max_sales_category(cursors[0], "shared")["Total_sales"].sum()
+    configure_query_cache()
+    for connection in connections:
+        connection.close()
+    assert after == pytest.approx(before + 3000)
+
+def test_query_plans_are_captured_as_json_lines(sales_db, tmp_path):
+    connection, cursor = sales_db
+    plan_file = tmp_path / "query_plans.jsonl"
+    plans_df = capture_query_plans(cursor, "testing", str(plan_file))
+    plans = [json.loads(line) for line in plan_file.read_text().splitlines()]
+    testcase = {"top_sell_country_category", "top_product_specs", "total_distinct_products_sold", "max_sales_category", "extract_data_from_db"}
+    assert len(plans) == len(plans_df)
+    assert {plan["query"] for plan in plans} == testcase
+    assert all(plan["db_name"] == "testing" and plan["captured_at"] for plan in plans)
+
+def test_sales_table_partitions():
+    country_query = " ".join(sales_table_query("testing", partition_by = "country", partition_values = ["Mexico", "US"]).split())
+    date_query = " ".join(sales_table_query("testing", partition_by = "date", partition_values = ["2024-01-01"]).split())
+    assert "PRIMARY KEY (sale_id, country)" in country_query
+    assert "PARTITION BY LIST COLUMNS(country) (PARTITION p_0 VALUES IN ('Mexico'), PARTITION p_1 VALUES IN ('US'))" in country_query
+    assert "PRIMARY KEY (sale_id, loaded_at)" in date_query
+    assert ("PARTITION BY RANGE (UNIX_TIMESTAMP(loaded_at)) (PARTITION p_20240101 VALUES LESS THAN (UNIX_TIMESTAMP('2024-01-01')), "
+            "PARTITION p_max VALUES LESS THAN MAXVALUE)") in date_query
+    assert "PRIMARY KEY (sale_id)" in " ".join(sales_table_query("testing").split())
+    with pytest.raises(ValueError):
+        sales_table_query("testing", partition_by = "country", backend = sqlite_backend)
+    with pytest.raises(ValueError):
+        sales_table_query("testing", partition_by = "month")
+
+def test_load_data_is_idempotent(sales_db):
+    connection, cursor = sales_db
+    transformed_data = transform_data(extract_data_from_db(cursor, "testing"))
+    load_data(transformed_data[1], cursor, connection, "testing")
+    load_data(transformed_data[1], cursor, connection, "testing")
+    testcase = 1000
+    cursor.execute("SELECT COUNT(*) FROM testing.transformed_sales")
+    assert cursor.fetchone()[0] == testcase
+
+def test_streaming_etl_categories_match_whole_extraction(sales_db):
+    connection, cursor = sales_db
+    report = streaming_etl(connection, connection, "testing", chunk_size = 70)
+    cursor.execute("SELECT sale_id, transact_category FROM testing.transformed_sales")
+    streamed = dict(cursor.fetchall())
+    transformed_df = transform_data(extract_data_from_db(cursor, "testing"))[0]
+    testcase = dict(zip(transformed_df["sale_id"], transformed_df["transact_category"]))
+    assert report["loaded_rows"] == 1000
+    assert set(testcase.values()) == {"High", "Medium", "Low"}
+    assert streamed == testcase
+
+def test_incremental_etl_keeps_watermark_on_db(sales_db):
+    connection, cursor = sales_db
+    incremental_etl(connection, connection, "testing", chunk_size = 300)
+    populate_sales_table(generate_sales_chunks(500, seed = 2), cursor, connection, "testing")
+    report = incremental_etl(connection, connection, "testing", chunk_size = 300)
+    testcase = 1500
+    cursor.execute("SELECT COUNT(*), MAX(sale_id) FROM testing.transformed_sales")
+    loaded_rows, high_sale_id = cursor.fetchone()
+    assert report["loaded_rows"] == 500
+    assert loaded_rows == testcase
+    assert read_watermark(cursor, "testing", "transformed_sales") == high_sale_id
+
+def test_failed_full_refresh_is_reloaded_on_next_run(sales_db):
+    connection, cursor = sales_db
+    incremental_etl(connection, connection, "testing", chunk_size = 300)
+    # a text field holding bytes makes the chunks with product 1 fail
+    cursor.execute("UPDATE testing.product SET color = X'00' WHERE id = 1")
+    connection.commit()
+    report = incremental_etl(connection, connection, "testing", chunk_size = 300, full_refresh = True)
+    assert len(report["failed_chunks"]) > 0
+    cursor.execute("UPDATE testing.product SET color = 'red' WHERE id = 1")
+    connection.commit()
+    incremental_etl(connection, connection, "testing", chunk_size = 300)
+    testcase = 1000
+    cursor.execute("SELECT COUNT(*) FROM testing.transformed_sales")
+    assert cursor.fetchone()[0] == testcase
+
+if __name__ == "__main__":
+    pytest.main()